@@ -0,0 +1,2 @@
+#!/bin/sh
+exec python3 /usr/lib/live-installer/headless.py "$@"
@@ -0,0 +1,244 @@
+import os
+import re
+import time
+import warnings
+
+import commands
+
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        import crypt
+except ImportError:
+    crypt = None
+
+# Account databases, edited the way useradd/usermod/passwd would
+DATABASES = ['passwd', 'shadow', 'group', 'gshadow']
+
+# Used when the target's login.defs and default/useradd don't say otherwise
+LOGIN_DEFS = {
+    'UID_MIN': '1000',
+    'UID_MAX': '60000',
+    'GID_MIN': '1000',
+    'GID_MAX': '60000',
+    'PASS_MIN_DAYS': '0',
+    'PASS_MAX_DAYS': '99999',
+    'PASS_WARN_AGE': '7',
+    'USERGROUPS_ENAB': 'yes',
+    'CREATE_HOME': 'no',
+}
+USERADD_DEFAULTS = {
+    'HOME': '/home',
+    'SHELL': '/bin/sh',
+    'SKEL': '/etc/skel',
+}
+
+
+def hash_password(password):
+    ''' Return the SHA-512 crypt hash of password '''
+    if crypt is not None:
+        return crypt.crypt(password, crypt.mksalt(crypt.METHOD_SHA512))
+    # the password goes through stdin, it doesn't show up in the process list
+    result = commands.run(["openssl", "passwd", "-6", "-stdin"],
+                          input=password, timeout=30)
+    if not result.ok:
+        raise Exception("Could not hash the password: %s" % result)
+    return result.output.strip()
+
+
+def read_settings(path, defaults, separator=None):
+    ''' Read a KEY VALUE (or KEY=VALUE) configuration file on top of defaults '''
+    settings = dict(defaults)
+    try:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if separator:
+                    key, _, value = line.partition(separator)
+                else:
+                    key, value = (line.split(None, 1) + [''])[:2]
+                settings[key.strip()] = value.strip().strip('"')
+    except FileNotFoundError:
+        pass
+    return settings
+
+
+class Accounts(object):
+    ''' Creates users and sets passwords by editing the account files under root '''
+    # Nothing runs inside the target, so this takes milliseconds and no
+    # password ever ends up on a command line. Changes are kept in memory until
+    # save(), which replaces every file it changed atomically.
+
+    def __init__(self, root="/target"):
+        self.root = root
+        self.entries = {}
+        self.changed = set()
+        self.login_defs = read_settings(self.path('etc/login.defs'), LOGIN_DEFS)
+        self.defaults = read_settings(self.path('etc/default/useradd'),
+                                     USERADD_DEFAULTS, '=')
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def database(self, name):
+        ''' The entries of /etc/<name>, a list of field lists '''
+        if name not in self.entries:
+            entries = []
+            try:
+                with open(self.path('etc/' + name)) as f:
+                    for line in f:
+                        line = line.rstrip('\n')
+                        if line:
+                            entries.append(line.split(':'))
+            except FileNotFoundError:
+                if name != 'gshadow':
+                    raise
+                entries = None
+            self.entries[name] = entries
+        return self.entries[name]
+
+    def find(self, name, key):
+        for entry in self.database(name) or []:
+            if entry[0] == key:
+                return entry
+        return None
+
+    def add(self, name, entry):
+        if self.database(name) is not None:
+            self.database(name).append(entry)
+            self.changed.add(name)
+
+    def free_id(self, name, first, last, wanted=None):
+        ''' Lowest id above the ones in use between first and last, like useradd picks them '''
+        used = set(int(entry[2]) for entry in self.database(name)
+                   if entry[2].isdigit())
+        if wanted is not None and wanted not in used and first <= wanted <= last:
+            return wanted
+        candidates = [i for i in used if first <= i <= last]
+        new = max(candidates) + 1 if candidates else first
+        if new > last:
+            raise Exception("No free id left in /etc/%s" % name)
+        return new
+
+    def add_group(self, group, gid=None):
+        if self.find('group', group) is not None:
+            raise Exception("Group %s already exists" % group)
+        gid = self.free_id('group', int(self.login_defs['GID_MIN']),
+                           int(self.login_defs['GID_MAX']), gid)
+        self.add('group', [group, 'x', str(gid), ''])
+        self.add('gshadow', [group, '!', '', ''])
+        return gid
+
+    def add_user(self, username, password=None, real_name='', groups=()):
+        ''' Create a user (and its own group), returns (uid, gid) '''
+        if self.find('passwd', username) is not None:
+            raise Exception("User %s already exists" % username)
+        uid = self.free_id('passwd', int(self.login_defs['UID_MIN']),
+                           int(self.login_defs['UID_MAX']))
+        if self.login_defs['USERGROUPS_ENAB'] == 'yes':
+            gid = self.add_group(username, uid)
+        else:
+            gid = int(self.defaults.get('GROUP', '100'))
+        home = os.path.join(self.defaults['HOME'], username)
+        self.add('passwd', [username, 'x', str(uid), str(gid),
+                            real_name.replace(':', ' '), home, self.defaults['SHELL']])
+        self.add('shadow', [username, '!', str(int(time.time() // 86400)),
+                            self.login_defs['PASS_MIN_DAYS'],
+                            self.login_defs['PASS_MAX_DAYS'],
+                            self.login_defs['PASS_WARN_AGE'], '', '', ''])
+        for group in groups:
+            self.add_to_group(username, group)
+        if password is not None:
+            self.set_password(username, password)
+        if self.login_defs['CREATE_HOME'] == 'yes':
+            self.create_home(home, uid, gid)
+        return uid, gid
+
+    def add_to_group(self, username, group):
+        ''' Add username to the members of group, missing groups are skipped like usermod -a would fail on them '''
+        entry = self.find('group', group)
+        if entry is None:
+            print("Group %s does not exist, %s not added to it" % (group, username))
+            return
+        for name in ['group', 'gshadow']:
+            entry = self.find(name, group)
+            if entry is None:
+                continue
+            # the members are the last field in both files
+            members = [m for m in entry[3].split(',') if m]
+            if username not in members:
+                entry[3] = ','.join(members + [username])
+                self.changed.add(name)
+
+    def set_password(self, username, password):
+        entry = self.find('shadow', username)
+        if entry is None:
+            raise Exception("User %s is not in /etc/shadow" % username)
+        entry[1] = hash_password(password)
+        entry[2] = str(int(time.time() // 86400))
+        self.changed.add('shadow')
+
+    def create_home(self, home, uid, gid):
+        ''' Create the home directory with the files of /etc/skel '''
+        target = self.path(home.lstrip('/'))
+        skel = self.path(self.defaults['SKEL'].lstrip('/'))
+        os.makedirs(target, exist_ok=True)
+        if os.path.isdir(skel):
+            for dirpath, dirnames, filenames in os.walk(skel):
+                relpath = os.path.relpath(dirpath, skel)
+                for name in dirnames:
+                    src = os.path.join(dirpath, name)
+                    if os.path.islink(src):
+                        os.symlink(os.readlink(src), os.path.join(target, relpath, name))
+                    else:
+                        os.makedirs(os.path.join(target, relpath, name), exist_ok=True)
+                for name in filenames:
+                    src = os.path.join(dirpath, name)
+                    dst = os.path.join(target, relpath, name)
+                    if os.path.islink(src):
+                        os.symlink(os.readlink(src), dst)
+                    else:
+                        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                            fdst.write(fsrc.read())
+                        os.chmod(dst, os.stat(src).st_mode & 0o7777)
+        for dirpath, dirnames, filenames in os.walk(target):
+            os.chown(dirpath, uid, gid)
+            for name in dirnames + filenames:
+                os.chown(os.path.join(dirpath, name), uid, gid, follow_symlinks=False)
+        os.chmod(target, 0o700)
+
+    def save(self):
+        ''' Write the changed account files, each one replaced in a single step '''
+        for name in DATABASES:
+            if name not in self.changed:
+                continue
+            path = self.path('etc/' + name)
+            st = os.stat(path)
+            tmp = path + '+'
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                for entry in self.entries[name]:
+                    f.write(':'.join(entry) + '\n')
+                f.flush()
+                # same owner and mode as before, shadow must not become readable
+                os.fchown(f.fileno(), st.st_uid, st.st_gid)
+                os.fchmod(f.fileno(), st.st_mode & 0o7777)
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        self.changed = set()
+
+
+def set_autologin(root, username):
+    ''' Make LightDM log username in automatically '''
+    path = os.path.join(root, 'etc/lightdm/lightdm.conf')
+    if not os.path.exists(path):
+        print("%s not found, autologin not set" % path)
+        return
+    with open(path) as f:
+        config = f.read()
+    config = re.sub(r'^#?(autologin-user)\s*=.*$', r'\1=%s' % username,
+                    config, flags=re.MULTILINE)
+    with open(path, 'w') as f:
+        f.write(config)
@@ -0,0 +1,363 @@
+#!/usr/bin/python3
+# Installs a synthetic live system on loop devices and times every step,
+# so a change to the installer can be measured without a spare machine:
+#
+#     python3 benchmark.py --output after.json --baseline before.json
+#
+# A source tree (small and large files, a passwd database and the few
+# programs the chroot steps run) is packed with mksquashfs and attached
+# read-only as the live medium. Sparse files attached as loop devices are
+# the target disks: one for the automated mode, two for the manual mode
+# (/ and swap on the first, /home on the second, formatted side by side).
+#
+# Needs root, losetup, parted, mksquashfs and mkfs.ext4, the scripts
+# installed by "make install", and nothing mounted on /target. Each step's
+# time is taken from the trace the installer records (tracing.py). Results
+# are written as JSON; with --baseline, steps that got slower by more than
+# --tolerance are listed and the exit status is 1.
+
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+# where the result files are relative to
+CWD = os.getcwd()
+if not os.path.isfile("installer.py"):
+    os.chdir("/usr/lib/live-installer")
+sys.path.insert(1, '/usr/lib/live-installer')
+
+import parted
+
+import commands
+import devices
+import mounts
+import tracing
+from installer import InstallerEngine, Setup
+
+WORKDIR = '/var/tmp/live-installer-benchmark'
+SCRIPTS = '/usr/lib/live-installer/scripts'
+MODES = ['automated', 'manual']
+# Programs the steps run inside the target
+PROGRAMS = ['sh', 'bash', 'cat', 'grep']
+# Slowdown against the baseline that counts as a regression
+TOLERANCE = 0.10
+# Steps shorter than this in the baseline are too noisy to compare
+MIN_SECONDS = 0.05
+
+
+def make_tree(root, small, large, large_mb):
+    ''' A live system to install: small files in nested directories, a few large ones '''
+    for path in ['etc/env.d', 'etc/conf.d', 'etc/X11/xorg.conf.d', 'etc/skel',
+                 'boot', 'home', 'tmp', 'var/log', 'dev', 'proc', 'sys', 'run']:
+        os.makedirs(os.path.join(root, path), exist_ok=True)
+    databases = {
+        'passwd': "root:x:0:0:root:/root:/bin/sh\n",
+        'shadow': "root:*:19000:0:99999:7:::\n",
+        'group': "root:x:0:\naudio:x:18:\nvideo:x:27:\nwheel:x:10:\nusers:x:100:\n",
+        'gshadow': "root:::\naudio:::\nvideo:::\nwheel:::\nusers:::\n",
+    }
+    for name, content in databases.items():
+        with open(os.path.join(root, 'etc', name), 'w') as f:
+            f.write(content)
+    os.chmod(os.path.join(root, 'etc/shadow'), 0o600)
+    os.chmod(os.path.join(root, 'etc/gshadow'), 0o600)
+    with open(os.path.join(root, 'etc/skel/.profile'), 'w') as f:
+        f.write("export PATH=/bin:/usr/bin\n")
+
+    for number in range(small):
+        directory = os.path.join(root, 'usr/share/bench/%02d/%02d' % (number % 97, number % 13))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'file%d' % number), 'wb') as f:
+            f.write(os.urandom(512 + number % 8192))
+    os.makedirs(os.path.join(root, 'usr/lib/bench'), exist_ok=True)
+    for number in range(large):
+        with open(os.path.join(root, 'usr/lib/bench/large%d' % number), 'wb') as f:
+            for _ in range(large_mb):
+                f.write(os.urandom(1024 * 1024))
+    add_programs(root, PROGRAMS)
+
+
+def add_programs(root, names):
+    ''' Copy programs of this system, with the libraries they load, into root '''
+    files = set()
+    for name in names:
+        path = shutil.which(name)
+        if path is None:
+            raise Exception("%s is needed in the target but was not found" % name)
+        files.add(path)
+        libraries = commands.output(['ldd', path])
+        files.update(re.findall(r'(/\S+) \(0x', libraries))
+    for path in files:
+        # the program may be found through a symlink (/bin -> usr/bin)
+        for copy in set([path, os.path.realpath(path)]):
+            destination = os.path.join(root, copy.lstrip('/'))
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.copy2(os.path.realpath(path), destination)
+    for name in names:
+        link = os.path.join(root, 'bin', name)
+        if not os.path.lexists(link):
+            os.makedirs(os.path.dirname(link), exist_ok=True)
+            os.symlink(shutil.which(name), link)
+
+
+def tree_size(root):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if not os.path.islink(path):
+                size += os.path.getsize(path)
+    return size
+
+
+def attach(path, read_only=False):
+    ''' Set up a loop device for path, returns its /dev/loopN '''
+    argv = ['losetup', '--find', '--show', '--partscan']
+    if read_only:
+        argv.append('--read-only')
+    result = commands.run(argv + [path], check=True)
+    return result.output.strip()
+
+
+def detach(loop):
+    result = commands.run(['losetup', '--detach', loop])
+    if not result.ok:
+        print(result)
+
+
+def make_disk(path, size_mb):
+    ''' A sparse file of size_mb attached as a loop device '''
+    with open(path, 'wb') as f:
+        f.truncate(size_mb * 1024 * 1024)
+    return attach(path)
+
+
+def wait_for(path, seconds=10):
+    deadline = time.monotonic() + seconds
+    while not os.path.exists(path):
+        if time.monotonic() > deadline:
+            raise Exception("%s did not show up" % path)
+        time.sleep(0.1)
+
+
+class BenchPartition(object):
+    ''' The parts of partitioning.Partition the installer engine uses '''
+
+    def __init__(self, partition, format_as, mount_as):
+        self.partition = partition
+        self.path = str(partition.path)
+        self.type = ''
+        self.format_as = format_as
+        self.mount_as = mount_as
+
+
+def manual_layout(disks):
+    ''' Partition the disks like a user would in the partition editor '''
+    # (disk, mount point, format, size in MB or 0 for the rest)
+    plan = [(disks[0], 'swap', 'swap', 256), (disks[0], '/', 'ext4', 0)]
+    if len(disks) > 1:
+        plan.append((disks[1], '/home', 'ext4', 0))
+    layout = []
+    for disk in disks:
+        commands.run(['parted', '--script', disk, 'mklabel', 'msdos'], check=True)
+        start = 1
+        number = 0
+        for _, mount_as, format_as, size in [entry for entry in plan if entry[0] == disk]:
+            end = '%dMiB' % (start + size) if size else '100%'
+            commands.run(['parted', '--script', '--align', 'optimal', disk,
+                          'mkpart', 'primary', '%dMiB' % start, end], check=True)
+            number += 1
+            start += size
+            layout.append((disk, number, format_as, mount_as))
+    partitions = []
+    for disk, number, format_as, mount_as in layout:
+        wait_for(devices.get_partition_path(disk, number))
+        for partition in parted.Disk(parted.getDevice(disk)).partitions:
+            if partition.number == number:
+                partitions.append(BenchPartition(partition, format_as, mount_as))
+    return partitions
+
+
+def make_setup(mode, disks):
+    setup = Setup()
+    setup.language = 'en_US'
+    setup.timezone = 'UTC'
+    setup.keyboard_model = 'pc105'
+    setup.keyboard_layout = 'us'
+    setup.keyboard_variant = ''
+    setup.username = 'bench'
+    setup.real_name = 'Benchmark'
+    setup.password1 = setup.password2 = 'bench'
+    setup.hostname = 'bench'
+    setup.grub_device = None
+    setup.gptonefi = devices.is_efi_supported()
+    if mode == 'automated':
+        setup.automated = True
+        setup.disk = setup.diskname = disks[0]
+        setup.partitions = []
+    else:
+        setup.automated = False
+        setup.partitions = manual_layout(disks)
+    return setup
+
+
+def steps(trace):
+    ''' Seconds spent in every step and scheduled task of a trace '''
+    seconds = {}
+    for event in trace:
+        if event.get('ph') == 'X' and event['cat'] in ('step', 'task'):
+            seconds[event['name']] = seconds.get(event['name'], 0.0) + event['dur'] / 1000000
+    return seconds
+
+
+def run(mode, media, disks, source_bytes):
+    ''' Install on disks in the given mode, returns the timings '''
+    errors = []
+    engine = InstallerEngine(make_setup(mode, disks))
+    engine.media = media
+    engine.set_progress_hook(lambda *args, **kwargs: None)
+    engine.set_error_hook(lambda message="": errors.append(message))
+    with tracing.lock:
+        del tracing.events[:]
+    start = time.monotonic()
+    try:
+        engine.start_installation()
+        if not errors:
+            engine.finish_installation()
+    finally:
+        # an error leaves the chroot shells and the mounts behind
+        engine.chroot.close()
+        for error in engine.mounts.teardown():
+            print(error)
+    seconds = time.monotonic() - start
+    if errors:
+        raise Exception("%s installation failed: %s" % (mode, '; '.join(errors)))
+    with tracing.lock:
+        timings = steps(tracing.events)
+    copy = timings.get('do_copy') or timings.get('do_copy_rsync')
+    return {
+        'seconds': round(seconds, 3),
+        'steps': dict((name, round(value, 3)) for name, value in timings.items()),
+        'source_bytes': source_bytes,
+        'copy_mb_s': round(source_bytes / copy / 1024 / 1024, 1) if copy else None,
+    }
+
+
+def compare(results, baseline, tolerance):
+    ''' Print results next to the baseline, returns the steps that got slower '''
+    regressions = []
+    for mode, result in results['modes'].items():
+        if mode not in baseline.get('modes', {}):
+            print("%s: not in the baseline" % mode)
+            continue
+        before = baseline['modes'][mode]
+        print("%s: %.2fs -> %.2fs" % (mode, before['seconds'], result['seconds']))
+        rows = [('total', before['seconds'], result['seconds'])]
+        rows += [(name, before['steps'][name], seconds)
+                 for name, seconds in sorted(result['steps'].items())
+                 if name in before['steps']]
+        for name, old, new in rows:
+            change = (new - old) / old if old else 0.0
+            slower = old >= MIN_SECONDS and change > tolerance
+            print("  %-28s %8.3fs %8.3fs %+7.1f%%%s" % (
+                name, old, new, change * 100, "  SLOWER" if slower else ""))
+            if slower:
+                regressions.append("%s/%s" % (mode, name))
+        if before.get('copy_mb_s') and result.get('copy_mb_s'):
+            print("  copy throughput %.1f MB/s -> %.1f MB/s" %
+                  (before['copy_mb_s'], result['copy_mb_s']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time installations on loop devices")
+    parser.add_argument('--mode', choices=MODES, action='append',
+                        help="mode to run, can be repeated (default: all)")
+    parser.add_argument('--runs', type=int, default=1,
+                        help="installations per mode, the fastest one is kept")
+    parser.add_argument('--small-files', type=int, default=20000)
+    parser.add_argument('--large-files', type=int, default=4)
+    parser.add_argument('--large-mb', type=int, default=64,
+                        help="size of each large file")
+    parser.add_argument('--disk-mb', type=int, default=4096,
+                        help="size of the root disk, swap comes on top in automated mode")
+    parser.add_argument('--workdir', default=WORKDIR)
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--baseline', help="earlier results to compare with")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    options = parser.parse_args()
+    output = os.path.join(CWD, options.output)
+
+    if os.getuid() != 0:
+        print("The benchmark sets up loop devices and mounts, run it as root")
+        return 2
+    if not os.path.isdir(SCRIPTS):
+        print("%s is missing, run make install first" % SCRIPTS)
+        return 2
+    if mounts.is_mounted('/target') or mounts.is_mounted('/source'):
+        print("/target or /source is in use, the benchmark would install over it")
+        return 2
+
+    os.makedirs(options.workdir, exist_ok=True)
+    workdir = tempfile.mkdtemp(dir=options.workdir)
+    loops = []
+    results = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'host': platform.node(),
+        'kernel': platform.release(),
+        'options': vars(options),
+        'modes': {},
+    }
+    try:
+        tree = os.path.join(workdir, 'tree')
+        print(" --> Building the source tree")
+        make_tree(tree, options.small_files, options.large_files, options.large_mb)
+        source_bytes = tree_size(tree)
+        image = os.path.join(workdir, 'filesystem.squashfs')
+        commands.run(['mksquashfs', tree, image, '-noappend', '-quiet'], check=True)
+        shutil.rmtree(tree)
+        media = attach(image, read_only=True)
+        loops.append(media)
+        # automated mode puts swap the size of the memory before the root partition
+        swap_mb = min(8800, int(round(1.1 / 1024 * devices.memory_kb(), -2)))
+        for mode in options.mode or MODES:
+            for attempt in range(options.runs):
+                disks = []
+                for number in range(1 if mode == 'automated' else 2):
+                    size = options.disk_mb + (swap_mb + 1400 if mode == 'automated' else 300)
+                    disk = make_disk(os.path.join(workdir, '%s%d.img' % (mode, number)), size)
+                    loops.append(disk)
+                    disks.append(disk)
+                print(" --> %s installation %d of %d" % (mode, attempt + 1, options.runs))
+                result = run(mode, media, disks, source_bytes)
+                print(" --> %s: %.2fs" % (mode, result['seconds']))
+                for disk in disks:
+                    detach(disk)
+                    loops.remove(disk)
+                if mode not in results['modes'] or result['seconds'] < results['modes'][mode]['seconds']:
+                    results['modes'][mode] = result
+    finally:
+        for loop in loops:
+            detach(loop)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Results written to %s" % output)
+    if options.baseline:
+        with open(os.path.join(CWD, options.baseline)) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        if regressions:
+            print("Slower than the baseline: %s" % ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
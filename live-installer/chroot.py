@@ -0,0 +1,119 @@
+import os
+import subprocess
+import threading
+
+import dryrun
+import tracing
+
+
+class Shell(object):
+    ''' One /bin/sh running inside the chroot, reading commands from a pipe '''
+    # Every command is followed by a marker line carrying its exit status, so
+    # the output of one command ends where its marker starts.
+
+    def __init__(self, root):
+        self.marker = ("__live_installer_%s__" % os.urandom(8).hex()).encode()
+        self.proc = subprocess.Popen(["chroot", root, "/bin/sh"],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT)
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def send(self, commands):
+        script = b''
+        for command in commands:
+            # a subshell keeps exit/cd/set of one command away from the others,
+            # stdin is the pipe so commands must not read it
+            script += b"( %s\n) </dev/null 2>&1\nprintf '\\n%s %%d\\n' $?\n" % (
+                command.encode(), self.marker)
+        self.proc.stdin.write(script)
+        self.proc.stdin.flush()
+
+    def receive(self):
+        ''' Read the output of the next command, returns (status, output) '''
+        lines = []
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                raise Exception("chroot shell exited with status %s" %
+                                self.proc.wait())
+            if line.startswith(self.marker + b' '):
+                break
+            lines.append(line)
+        output = b''.join(lines)
+        # drop the newline the marker was printed with
+        if output.endswith(b'\n'):
+            output = output[:-1]
+        return int(line.split()[1]), output.decode('utf-8', 'replace')
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        if self.proc.wait() != 0:
+            print("chroot shell exited with status %d" % self.proc.returncode)
+
+
+class Chroot(object):
+    ''' Runs commands inside root through long-lived shells instead of a new chroot per command '''
+    # A shell serves one command (or batch) at a time; when steps run side by
+    # side another shell is started, idle shells are kept for the next command.
+
+    def __init__(self, root="/target"):
+        self.root = root
+        self.idle = []
+        self.shells = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            while self.idle:
+                shell = self.idle.pop()
+                if shell.alive():
+                    return shell
+                self.shells.remove(shell)
+            shell = Shell(self.root)
+            self.shells.append(shell)
+            return shell
+
+    def release(self, shell):
+        with self.lock:
+            self.idle.append(shell)
+
+    def run(self, command):
+        ''' Run a shell command inside the chroot, returns (status, output) '''
+        return self.run_batch([command])[0]
+
+    def run_batch(self, commands):
+        ''' Run commands one after the other in the same shell, returns a (status, output) for each '''
+        if dryrun.plan is not None:
+            return [dryrun.plan.chroot(self.root, command) for command in commands]
+        # the whole batch is written before reading, keep batches to short commands
+        shell = self.acquire()
+        try:
+            shell.send(commands)
+            results = []
+            for command in commands:
+                # the commands run back to back, each one ends when its marker arrives
+                with tracing.span(command.split()[0] if command.split() else command,
+                                  'chroot') as trace:
+                    results.append(shell.receive())
+                    trace.args['status'] = results[-1][0]
+        except Exception:
+            with self.lock:
+                self.shells.remove(shell)
+            shell.proc.kill()
+            shell.proc.wait()
+            raise
+        self.release(shell)
+        return results
+
+    def close(self):
+        ''' Stop the shells, they keep the target busy and it could not be unmounted '''
+        with self.lock:
+            shells, self.shells, self.idle = self.shells, [], []
+        for shell in shells:
+            shell.close()
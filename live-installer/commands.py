@@ -0,0 +1,127 @@
+import os
+import shlex
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import dryrun
+import tracing
+
+# Commands taking longer than this are pointed out in the log
+SLOW = 2.0
+
+# (command, seconds, status) of every command run so far
+timings = []
+timings_lock = threading.Lock()
+
+
+class Result(object):
+    ''' What a command printed and how it ended '''
+
+    def __init__(self, argv, status, output, error, seconds, timed_out=False):
+        self.argv = argv
+        # None when the command could not be started or timed out
+        self.status = status
+        self.output = output
+        self.error = error
+        self.seconds = seconds
+        self.timed_out = timed_out
+
+    @property
+    def ok(self):
+        return self.status == 0
+
+    def __str__(self):
+        if self.timed_out:
+            return "'%s' timed out after %.1fs" % (join(self.argv), self.seconds)
+        return "'%s' exited with status %s%s" % (
+            join(self.argv), self.status,
+            (": " + self.error.strip()) if self.error and self.error.strip() else "")
+
+
+def join(argv):
+    return shlex.join(argv)
+
+
+def run(argv, timeout=None, input=None, env=None, capture=True, check=False, log=True):
+    ''' Run argv (a list, no shell), returns a Result; raises an exception on failure if check is set '''
+    if log:
+        print("EXECUTING: '%s'" % join(argv))
+    if dryrun.plan is not None:
+        status, output = dryrun.plan.command(argv)
+        return Result(argv, status, output, '', 0.0)
+    if env is not None:
+        env = dict(os.environ, **env)
+    pipe = subprocess.PIPE if capture else None
+    start = time.monotonic()
+    trace_start = tracing.now()
+    timed_out = False
+    try:
+        proc = subprocess.run(argv, input=input, env=env, timeout=timeout,
+                              stdout=pipe, stderr=pipe,
+                              stdin=None if input is not None else subprocess.DEVNULL,
+                              universal_newlines=True, errors='replace')
+        status, output, error = proc.returncode, proc.stdout or '', proc.stderr or ''
+    except subprocess.TimeoutExpired as detail:
+        timed_out = True
+        status, output, error = None, _text(detail.stdout), _text(detail.stderr)
+    except OSError as detail:
+        status, output, error = None, '', str(detail)
+    result = Result(argv, status, output, error, time.monotonic() - start, timed_out)
+    tracing.record(join(argv), 'command', trace_start, result.seconds * 1000000,
+                   {'status': status, 'timed_out': timed_out})
+    with timings_lock:
+        timings.append((join(argv), result.seconds, status))
+    if result.seconds > SLOW:
+        print("'%s' took %.1fs" % (join(argv), result.seconds))
+    if check and not result.ok:
+        raise Exception(str(result))
+    return result
+
+
+def _text(data):
+    if isinstance(data, bytes):
+        return data.decode('utf-8', 'replace')
+    return data or ''
+
+
+def output(argv, **kwargs):
+    ''' Standard output of argv without surrounding whitespace, '' if it failed to start '''
+    kwargs.setdefault('log', False)
+    return run(argv, **kwargs).output.strip()
+
+
+def run_batch(commands, workers=1, stop_on_error=False, **kwargs):
+    ''' Run several argv lists, at most workers at a time; returns their Results in order '''
+    if workers <= 1:
+        results = []
+        for argv in commands:
+            result = run(argv, **kwargs)
+            results.append(result)
+            if stop_on_error and not result.ok:
+                break
+        return results
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda argv: run(argv, **kwargs), commands))
+
+
+def spawn(argv):
+    ''' Start argv in the background without waiting for it '''
+    print("STARTING: '%s'" % join(argv))
+    try:
+        return subprocess.Popen(argv, stdin=subprocess.DEVNULL)
+    except OSError as detail:
+        print("Could not start '%s': %s" % (join(argv), detail))
+        return None
+
+
+def report(count=10):
+    ''' Print the slowest commands so far '''
+    with timings_lock:
+        slowest = sorted(timings, key=lambda timing: timing[1], reverse=True)[:count]
+        total = sum(seconds for _, seconds, _ in timings)
+        number = len(timings)
+    print("%d commands, %.1fs in total, slowest:" % (number, total))
+    for command, seconds, status in slowest:
+        print("  %6.2fs  %s  %s" % (seconds, status, command))
@@ -0,0 +1,390 @@
+import errno
+import fnmatch
+import os
+import shutil
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Largest range handed to the kernel in a single copy call
+CHUNK_SIZE = 8 * 1024 * 1024
+# Files of at least this size that report no holes are read block by block and
+# blocks of zeros are left as holes, like cp --sparse=always does; squashfs
+# (the live medium) reports every file as a single data extent
+SPARSE_MIN = 64 * 1024
+SPARSE_BLOCK = 4096
+SPARSE_CHUNK = 1024 * 1024
+ZERO_BLOCK = bytes(SPARSE_BLOCK)
+# Seconds between two calls of the checkpoint hook
+CHECKPOINT_INTERVAL = 5
+# Paths of the live system that are not installed, relative to its root
+EXCLUDE_DIRS = "data/* dev/* proc/* sys/* tmp/* run/* lost+found source target".split()
+
+
+class CopyEngine(object):
+    ''' Copies a directory tree with a pool of workers '''
+    # File data is moved by the kernel (copy_file_range, falling back to sendfile),
+    # holes are kept, and ownership, permissions, xattrs (and so ACLs), timestamps
+    # and hard links are preserved. Like rsync --no-D, device files, fifos and
+    # sockets are skipped.
+
+    def __init__(self, source, dest, exclude=(), workers=None, progresshook=None, manifest=None,
+                 checkpointhook=None):
+        self.source = source.rstrip('/') or '/'
+        self.dest = dest.rstrip('/') or '/'
+        # patterns relative to source, e.g. "dev/*" or "lost+found"
+        self.exclude = list(exclude)
+        # a manifest.Manifest of source replaces the tree walk, its exclusions are used as is
+        self.manifest = manifest
+        # called with the high-water mark: every entry before it has been copied
+        self.checkpointhook = checkpointhook
+        self.high_water = 0
+        self._finished = set()
+        self._last_checkpoint = 0
+        self._checkpoint_lock = threading.Lock()
+        self.workers = workers or min(16, 2 * (os.cpu_count() or 1))
+        self.progresshook = progresshook
+        self.use_copy_file_range = hasattr(os, 'copy_file_range')
+        self.errors = []
+        # bytes of regular file data, hard links count once
+        self.total = 0
+        self.copied = 0
+        self._lock = threading.Lock()
+        # keep the pending queue short, the tree walk is much faster than the copy
+        self._slots = threading.BoundedSemaphore(self.workers * 64)
+
+    def is_excluded(self, relpath):
+        for pattern in self.exclude:
+            if fnmatch.fnmatch(relpath, pattern):
+                return True
+        return False
+
+    def walk(self):
+        ''' Yield (relpath, stat) for the source tree, parents before children '''
+        stack = ['']
+        while stack:
+            reldir = stack.pop()
+            try:
+                entries = sorted(os.scandir(os.path.join(self.source, reldir)),
+                                 key=lambda entry: entry.name)
+            except OSError as detail:
+                self.add_error(reldir, detail)
+                continue
+            subdirs = []
+            for entry in entries:
+                relpath = os.path.join(reldir, entry.name)
+                if self.is_excluded(relpath):
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError as detail:
+                    self.add_error(relpath, detail)
+                    continue
+                yield relpath, st
+                if stat.S_ISDIR(st.st_mode):
+                    subdirs.append(relpath)
+            stack.extend(reversed(subdirs))
+
+    def entries(self):
+        ''' Yield (relpath, stat, link, xattrs) for everything to copy '''
+        # link is the relpath of an earlier hard link to the same file, xattrs
+        # is False when the entry is known to have no extended attributes
+        if self.manifest is not None:
+            for index in range(len(self.manifest)):
+                relpath = self.manifest.path(index)
+                try:
+                    st = os.lstat(os.path.join(self.source, relpath))
+                except OSError as detail:
+                    self.add_error(relpath, detail)
+                    continue
+                link = self.manifest.links[index]
+                yield (relpath, st, self.manifest.path(link) if link >= 0 else None,
+                       self.manifest.has_xattrs(index))
+            return
+        inodes = {}
+        for relpath, st in self.walk():
+            link = None
+            if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                key = (st.st_dev, st.st_ino)
+                link = inodes.get(key)
+                if link is None:
+                    inodes[key] = relpath
+            yield relpath, st, link, True
+
+    def scan(self):
+        ''' Return the number of bytes to copy, walking the source if there is no manifest '''
+        if self.manifest is not None:
+            self.total = self.manifest.total_size
+            return self.total
+        total = 0
+        for relpath, st, link, xattrs in self.entries():
+            if stat.S_ISREG(st.st_mode) and link is None:
+                total += st.st_size
+        self.total = total
+        return total
+
+    def run(self, skip=0):
+        ''' Copy the tree, returns True if every entry was copied '''
+        # skip is a high-water mark reported by an earlier run over the same tree
+        self.errors = []
+        self.copied = 0
+        self.high_water = skip
+        self._finished = set()
+        dirs = []
+        links = []
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for index, (relpath, st, link, xattrs) in enumerate(self.entries()):
+                if index < skip:
+                    # copied already, but directory metadata and hard links are only done at the end
+                    if stat.S_ISDIR(st.st_mode):
+                        dirs.append((relpath, st, xattrs))
+                    elif stat.S_ISREG(st.st_mode):
+                        if link is not None:
+                            links.append((link, relpath))
+                        else:
+                            self.copied += st.st_size
+                    continue
+                dst = os.path.join(self.dest, relpath)
+                try:
+                    if stat.S_ISDIR(st.st_mode):
+                        if not os.path.isdir(dst) or os.path.islink(dst):
+                            self.remove(dst)
+                            os.mkdir(dst, 0o700)
+                        # permissions and times are applied once the contents are in place
+                        dirs.append((relpath, st, xattrs))
+                        self.finish(index)
+                    elif stat.S_ISLNK(st.st_mode):
+                        self.remove(dst)
+                        os.symlink(os.readlink(os.path.join(
+                            self.source, relpath)), dst)
+                        self.copy_metadata(relpath, st, xattrs)
+                        self.finish(index)
+                    elif stat.S_ISREG(st.st_mode):
+                        if link is not None:
+                            links.append((link, relpath))
+                            self.finish(index)
+                            continue
+                        self._slots.acquire()
+                        pool.submit(self.copy_file, index, relpath, st, xattrs)
+                    else:
+                        self.finish(index)
+                except OSError as detail:
+                    self.add_error(relpath, detail)
+
+        for target, relpath in links:
+            dst = os.path.join(self.dest, relpath)
+            try:
+                self.remove(dst)
+                os.link(os.path.join(self.dest, target), dst)
+            except OSError as detail:
+                self.add_error(relpath, detail)
+
+        # deepest first, so setting a parent's mtime is not undone by its children
+        for relpath, st, xattrs in reversed(dirs):
+            try:
+                self.copy_metadata(relpath, st, xattrs)
+            except OSError as detail:
+                self.add_error(relpath, detail)
+
+        if self.checkpointhook is not None:
+            with self._checkpoint_lock:
+                self.checkpointhook(self.high_water)
+        return not self.errors
+
+    def copy_file(self, index, relpath, st, xattrs=True):
+        try:
+            src_fd = os.open(os.path.join(self.source, relpath), os.O_RDONLY)
+            try:
+                dst = os.path.join(self.dest, relpath)
+                self.remove(dst)
+                dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                try:
+                    self.copy_data(src_fd, dst_fd, st.st_size, relpath)
+                finally:
+                    os.close(dst_fd)
+            finally:
+                os.close(src_fd)
+            self.copy_metadata(relpath, st, xattrs)
+            self.finish(index)
+        except OSError as detail:
+            self.add_error(relpath, detail)
+        finally:
+            self._slots.release()
+
+    def copy_data(self, src_fd, dst_fd, size, relpath):
+        ''' Copy the data extents of src_fd, leaving holes unallocated '''
+        offset = 0
+        copied = 0
+        while offset < size:
+            try:
+                data = os.lseek(src_fd, offset, os.SEEK_DATA)
+                hole = os.lseek(src_fd, data, os.SEEK_HOLE)
+            except OSError as detail:
+                if detail.errno == errno.ENXIO:
+                    break  # nothing but a hole up to the end of the file
+                # SEEK_DATA/SEEK_HOLE not supported, treat it all as data
+                data, hole = offset, size
+            if data == 0 and hole >= size and size >= SPARSE_MIN:
+                # no holes reported, there may still be some
+                copied = self.copy_sparse(src_fd, dst_fd, size, relpath)
+                break
+            copied += self.copy_range(src_fd, dst_fd, data,
+                                      min(hole, size) - data, relpath)
+            offset = hole
+        os.ftruncate(dst_fd, size)
+        if copied < size:
+            # holes are part of the total too
+            self.advance(size - copied, relpath)
+
+    def copy_sparse(self, src_fd, dst_fd, size, relpath):
+        ''' Copy src_fd, seeking over the blocks of zeros instead of writing them '''
+        offset = 0
+        while offset < size:
+            chunk = os.pread(src_fd, min(SPARSE_CHUNK, size - offset), offset)
+            if not chunk:
+                break  # the source file shrank while copying
+            # write the runs of blocks that are not all zeros
+            start = None
+            for block in range(0, len(chunk), SPARSE_BLOCK):
+                zero = chunk[block:block + SPARSE_BLOCK] == ZERO_BLOCK[:len(chunk) - block]
+                if zero and start is not None:
+                    self.write_all(dst_fd, chunk[start:block], offset + start)
+                    start = None
+                elif not zero and start is None:
+                    start = block
+            if start is not None:
+                self.write_all(dst_fd, chunk[start:], offset + start)
+            offset += len(chunk)
+            self.advance(len(chunk), relpath)
+        return offset
+
+    def write_all(self, fd, data, offset):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    def copy_range(self, src_fd, dst_fd, offset, count, relpath):
+        start = offset
+        end = offset + count
+        while offset < end:
+            length = min(CHUNK_SIZE, end - offset)
+            if self.use_copy_file_range:
+                try:
+                    copied = os.copy_file_range(
+                        src_fd, dst_fd, length, offset, offset)
+                except OSError as detail:
+                    # cross-filesystem copies are refused by older and newer kernels alike
+                    if detail.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                            errno.EOPNOTSUPP):
+                        raise
+                    self.use_copy_file_range = False
+                    continue
+            else:
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                copied = os.sendfile(dst_fd, src_fd, offset, length)
+            if copied == 0:
+                break  # the source file shrank while copying
+            offset += copied
+            self.advance(copied, relpath)
+        return offset - start
+
+    def copy_metadata(self, relpath, st, xattrs=True):
+        ''' Apply owner, mode, xattrs and times of the source to the copy '''
+        src = os.path.join(self.source, relpath)
+        dst = os.path.join(self.dest, relpath)
+        is_link = stat.S_ISLNK(st.st_mode)
+        # chown first, it clears setuid bits and file capabilities
+        os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+        if not is_link:
+            os.chmod(dst, stat.S_IMODE(st.st_mode))
+        try:
+            names = os.listxattr(src, follow_symlinks=False) if xattrs else []
+        except OSError as detail:
+            if detail.errno not in (errno.ENOTSUP, errno.EOPNOTSUPP):
+                raise
+            names = []
+        for name in names:
+            try:
+                os.setxattr(dst, name, os.getxattr(src, name, follow_symlinks=False),
+                            follow_symlinks=False)
+            except OSError as detail:
+                # user.* attributes are not allowed on symlinks
+                if not (is_link and detail.errno == errno.EPERM):
+                    raise
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns),
+                 follow_symlinks=False)
+
+    def remove(self, path):
+        ''' Make room for a new entry, rsync-style replacement of whatever is there '''
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return
+        if stat.S_ISDIR(st.st_mode):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+
+    def finish(self, index):
+        ''' Mark an entry as copied and move the high-water mark past finished entries '''
+        with self._lock:
+            self._finished.add(index)
+            while self.high_water in self._finished:
+                self._finished.remove(self.high_water)
+                self.high_water += 1
+            high_water = self.high_water
+            now = time.monotonic()
+            if self.checkpointhook is None or now - self._last_checkpoint < CHECKPOINT_INTERVAL:
+                return
+            self._last_checkpoint = now
+        with self._checkpoint_lock:
+            self.checkpointhook(high_water)
+
+    def advance(self, nbytes, relpath):
+        with self._lock:
+            self.copied += nbytes
+            copied = self.copied
+        if self.progresshook is not None:
+            self.progresshook(copied, relpath)
+
+    def add_error(self, relpath, detail):
+        print("Could not copy /%s: %s" % (relpath, detail))
+        with self._lock:
+            self.errors.append((relpath, detail))
+
+
+class Throughput(object):
+    ''' Tracks the copy speed and estimates the remaining time '''
+
+    def __init__(self, total, interval=1.0):
+        self.total = total
+        # seconds between two speed samples
+        self.interval = interval
+        self.rate = 0.0
+        self.start = self.last_time = time.monotonic()
+        self.last_current = 0
+        self._lock = threading.Lock()
+
+    def update(self, current):
+        ''' Record the bytes done so far and return a "MB/s, time left" summary '''
+        with self._lock:
+            now = time.monotonic()
+            if now - self.last_time >= self.interval:
+                rate = (current - self.last_current) / (now - self.last_time)
+                # smooth it, a burst of small files should not make the ETA jump around
+                self.rate = rate if not self.rate else 0.3 * rate + 0.7 * self.rate
+                self.last_time, self.last_current = now, current
+            return self.describe(current)
+
+    def describe(self, current):
+        if not self.rate:
+            return "hız hesaplanıyor"
+        left = int(max(0, self.total - current) / self.rate)
+        if left >= 60:
+            eta = "%d dk %02d sn kaldı" % divmod(left, 60)
+        else:
+            eta = "%d sn kaldı" % left
+        return "%.1f MB/s, %s" % (self.rate / 1000000, eta)
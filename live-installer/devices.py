@@ -0,0 +1,586 @@
+import errno
+import fcntl
+import os
+import socket
+import stat
+import struct
+import threading
+import time
+
+import commands
+import dryrun
+import mounts
+
+# udev keeps one symlink per filesystem UUID here
+BY_UUID = '/dev/disk/by-uuid'
+
+EFI_MOUNT_POINT = '/boot/efi'
+# Prebuilt ext4 root filesystem for automated installs, written with deploy_image()
+# Build it with `e2image -ra` so that unused (and all-zero) blocks are holes in the image file
+ROOT_IMAGE = '/run/live/medium/live/filesystem.img'
+SWAP_MOUNT_POINT = 'swap'
+
+LIVE_MEDIUM = '/run/live/medium'
+SYS_BLOCK = '/sys/block'
+# disks that are not virtual but can't be installed to: optical and floppy drives
+EXCLUDED_DISKS = ('sr', 'fd')
+SIZE_UNITS = ['B', 'kB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB', 'YB']
+
+# (names in SYS_BLOCK, Disk records) of the last list_disks()
+disk_cache = None
+disk_cache_lock = threading.Lock()
+
+# netlink family and multicast group of the kernel's device events (linux/netlink.h)
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+
+# ext2/3/4 superblock, 1024 bytes into the partition (linux/fs/ext4/ext4.h)
+EXT_SUPERBLOCK = 1024
+EXT_MAGIC = 0xEF53
+EXT_COMPAT_HAS_JOURNAL = 0x4
+EXT_INCOMPAT_EXTENTS = 0x40
+EXT_INCOMPAT_64BIT = 0x80
+# read-only mount options that also keep a dirty journal from being replayed
+READ_ONLY_OPTIONS = {
+    'ext3': 'ro,noload',
+    'ext4': 'ro,noload',
+    'xfs': 'ro,norecovery',
+    'btrfs': 'ro,nologreplay',
+}
+# in-kernel drivers of filesystems blkid names otherwise, tried when mount(8) has no
+# helper for them either (ntfs without ntfs-3g)
+OTHER_DRIVERS = {
+    'ntfs': ['ntfs3'],
+}
+# files naming the installed OS, with the variable holding the name
+RELEASE_FILES = [('etc/os-release', 'PRETTY_NAME'),
+                 ('usr/lib/os-release', 'PRETTY_NAME'),
+                 ('etc/lsb-release', 'DISTRIB_DESCRIPTION')]
+
+
+class UuidIndex(object):
+    ''' Filesystem UUIDs of the block devices, read once and reused '''
+    # Built from the /dev/disk/by-uuid symlinks instead of probing every disk
+    # with blkid for each lookup. Anything that creates filesystems has to call
+    # invalidate() so the next lookup waits for udev and reads the links again.
+
+    def __init__(self, directory=BY_UUID):
+        self.directory = directory
+        self.uuids = None
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        with self.lock:
+            self.uuids = None
+
+    def refresh(self):
+        ''' Wait for udev to process new filesystems and read the UUID links '''
+        result = commands.run(["udevadm", "settle", "--timeout=10"], timeout=30)
+        if not result.ok:
+            print("Could not wait for udev: %s" % result)
+        uuids = {}
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            device = os.path.realpath(os.path.join(self.directory, name))
+            uuids[device] = name
+        print("Found %d filesystem UUIDs" % len(uuids))
+        return uuids
+
+    def get(self, path):
+        ''' UUID of the filesystem on path, or None '''
+        device = os.path.realpath(path)
+        with self.lock:
+            if self.uuids is None:
+                self.uuids = self.refresh()
+            if device not in self.uuids:
+                # not linked by udev (yet), probe just this device
+                uuid = commands.output(["blkid", "-o", "value", "-s", "UUID", device],
+                                       timeout=30)
+                self.uuids[device] = uuid or None
+            return self.uuids[device]
+
+
+class BlockEvents(object):
+    ''' Listens for the kernel's add/change/remove events of disks and partitions '''
+    # A netlink socket the caller polls (fileno()); read() returns the disks
+    # the pending events touched. The kernel sends the event before udev has
+    # created or updated the device node, wait_for_udev() before reading them.
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM | socket.SOCK_NONBLOCK,
+                                    NETLINK_KOBJECT_UEVENT)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+        self.socket.bind((0, UEVENT_KERNEL_GROUP))
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def read(self):
+        ''' {disk path: action} of the block device events received so far '''
+        disks = {}
+        while True:
+            try:
+                message = self.socket.recv(65536)
+            except BlockingIOError:
+                break
+            except OSError as detail:
+                # ENOBUFS: events were lost, the caller has to look at everything
+                print("Lost block device events: %s" % detail)
+                disks[None] = 'change'
+                break
+            event = parse_uevent(message)
+            if event is None or event.get('SUBSYSTEM') != 'block' or 'DEVNAME' not in event:
+                continue
+            if event.get('DEVTYPE') == 'partition':
+                # /devices/.../block/sda/sda1, the disk of a partition is the parent directory
+                disk = '/dev/' + os.path.basename(os.path.dirname(event['DEVPATH']))
+                action = 'change'
+            else:
+                disk = '/dev/' + event['DEVNAME']
+                action = event['ACTION']
+            if disks.get(disk) != 'remove':
+                disks[disk] = action
+        return disks
+
+    def wait_for_udev(self):
+        commands.run(['udevadm', 'settle', '--timeout=5'], log=False)
+
+    def close(self):
+        self.socket.close()
+
+
+def parse_uevent(message):
+    ''' The fields of a kernel uevent: ACTION@DEVPATH and KEY=VALUE fields separated by NUL bytes '''
+    fields = message.split(b'\0')
+    if b'@' not in fields[0]:
+        return None
+    event = {}
+    for field in fields[1:]:
+        key, _, value = field.partition(b'=')
+        if key:
+            event[key.decode('ascii', 'replace')] = value.decode('utf-8', 'replace')
+    return event
+
+
+def is_efi_supported():
+    # Are we running under with efi ?
+    commands.run(["modprobe", "efivars"])
+    return os.path.exists("/proc/efi") or os.path.exists("/sys/firmware/efi")
+
+
+def path_exists(*args):
+    return os.path.exists(os.path.join(*args))
+
+
+class Disk(object):
+    ''' A disk the installer can install to, as sysfs describes it '''
+
+    def __init__(self, name, size, removable=False, rotational=False, model='', transport=''):
+        self.name = name
+        self.path = '/dev/' + name
+        # bytes
+        self.size = size
+        self.removable = removable
+        self.rotational = rotational
+        self.model = model
+        # usb, nvme, sata, ata, scsi, virtio, mmc or '' when not known
+        self.transport = transport
+
+    @property
+    def description(self):
+        # manufacturer's size for show, e.g. in GB, not GiB!
+        size, unit = self.size, 0
+        while size >= 1000 and unit < len(SIZE_UNITS) - 1:
+            size /= 1000
+            unit += 1
+        description = '{} ({} {})'.format(self.model or self.name, int(size), SIZE_UNITS[unit])
+        if self.removable:
+            description = ('Removable:') + ' ' + description
+        return description
+
+    def __repr__(self):
+        return "Disk(%s, %s, %s)" % (self.path, self.size, self.transport or '?')
+
+
+def read_sysfs(*path):
+    ''' Contents of a sysfs attribute, '' if it is not there '''
+    try:
+        with open(os.path.join(SYS_BLOCK, *path)) as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
+
+def disk_transport(name, device_path):
+    ''' How the disk is attached, guessed from where sysfs puts it like lsblk's TRAN '''
+    if name.startswith('nvme'):
+        return 'nvme'
+    if name.startswith('mmcblk'):
+        return 'mmc'
+    for part, transport in (('/usb', 'usb'), ('/virtio', 'virtio')):
+        if part in device_path:
+            return transport
+    if '/ata' in device_path:
+        return 'sata' if read_sysfs(name, 'device', 'vendor') == 'ATA' else 'ata'
+    if os.path.isdir(os.path.join(SYS_BLOCK, name, 'device', 'scsi_disk')):
+        return 'scsi'
+    return ''
+
+
+def disk_of(device):
+    ''' /dev/sdb1 -> /dev/sdb, /dev/nvme0n1p2 -> /dev/nvme0n1; a disk is its own disk '''
+    name = os.path.basename(os.path.realpath(device))
+    if os.path.exists(os.path.join('/sys/class/block', name, 'partition')):
+        name = os.path.basename(os.path.dirname(os.path.realpath(
+            os.path.join('/sys/class/block', name))))
+    return '/dev/' + name
+
+
+def read_disks():
+    ''' Disk records of the disks in sysfs, by name, without the live medium '''
+    disks = []
+    live_device = mounts.mount_source(LIVE_MEDIUM)
+    if live_device is not None and live_device.startswith('/dev/'):
+        live_device = disk_of(live_device)
+        print("Excluding %s (detected as the live device)" % live_device)
+    for name in sorted(os.listdir(SYS_BLOCK)):
+        device_path = os.path.realpath(os.path.join(SYS_BLOCK, name))
+        # loop, ram, zram, device mapper, md and nullb devices are not disks
+        if device_path.startswith('/sys/devices/virtual/') or name.startswith(EXCLUDED_DISKS):
+            continue
+        if '/dev/' + name == live_device:
+            continue
+        try:
+            size = int(read_sysfs(name, 'size')) * 512
+        except ValueError:
+            size = 0
+        if not size:
+            # an empty card reader or a disk that went away
+            continue
+        model = read_sysfs(name, 'device', 'model') or read_sysfs(name, 'device', 'name')
+        disks.append(Disk(name, size,
+                          removable=read_sysfs(name, 'removable') == '1',
+                          rotational=read_sysfs(name, 'queue', 'rotational') == '1',
+                          model=' '.join(model.split()),
+                          transport=disk_transport(name, device_path)))
+    return disks
+
+
+def list_disks(refresh=False):
+    ''' The Disk records, read once and shared until a disk appears, goes away or refresh is set '''
+    global disk_cache
+    with disk_cache_lock:
+        names = tuple(sorted(os.listdir(SYS_BLOCK)))
+        if refresh or disk_cache is None or disk_cache[0] != names:
+            disk_cache = (names, read_disks())
+            print("Disks: %s" % disk_cache[1])
+        return list(disk_cache[1])
+
+
+def get_disks(refresh=False):
+    ''' (path, description) of the disks, see list_disks() '''
+    return [(disk.path, disk.description) for disk in list_disks(refresh)]
+
+
+def get_partition_path(disk, number):
+    ''' /dev/sda, 1 -> /dev/sda1 but /dev/nvme0n1, 1 -> /dev/nvme0n1p1 (same for loop, mmcblk, md) '''
+    if disk[-1:].isdigit():
+        return "%sp%d" % (disk, number)
+    return "%s%d" % (disk, number)
+
+
+class Superblock(object):
+    ''' What a partition's superblock says about its filesystem, read without mounting it '''
+
+    def __init__(self, type, label='', uuid='', size=None, free=None, usage='filesystem',
+                 generation=None):
+        self.type = type
+        self.label = label
+        self.uuid = uuid
+        # changes whenever the filesystem is written to, None if not known (only ext2/3/4)
+        self.generation = generation
+        # blkid's USAGE: filesystem, or other (swap), raid, crypto
+        self.usage = usage
+        # bytes, only known for filesystems read here (ext2/3/4)
+        self.size = size
+        self.free = free
+
+
+def read_ext_superblock(path):
+    ''' The Superblock of the ext2/3/4 filesystem on path, None if there is none '''
+    try:
+        with open(path, 'rb') as f:
+            f.seek(EXT_SUPERBLOCK)
+            data = f.read(1024)
+    except OSError:
+        return None
+    if len(data) < 1024 or struct.unpack_from('<H', data, 0x38)[0] != EXT_MAGIC:
+        return None
+    blocks, reserved, free = struct.unpack_from('<III', data, 0x04)
+    block_size = 1024 << struct.unpack_from('<I', data, 0x18)[0]
+    compat, _, incompat = struct.unpack_from('<III', data, 0x5C)
+    # last mount time, last write time and kilobytes written over its lifetime
+    generation = struct.unpack_from('<II', data, 0x2C) + struct.unpack_from('<Q', data, 0x178)
+    if incompat & EXT_INCOMPAT_64BIT:
+        blocks_hi, reserved_hi, free_hi = struct.unpack_from('<III', data, 0x150)
+        blocks |= blocks_hi << 32
+        reserved |= reserved_hi << 32
+        free |= free_hi << 32
+    if incompat & (EXT_INCOMPAT_EXTENTS | EXT_INCOMPAT_64BIT):
+        fstype = 'ext4'
+    elif compat & EXT_COMPAT_HAS_JOURNAL:
+        fstype = 'ext3'
+    else:
+        fstype = 'ext2'
+    uuid = data[0x68:0x78].hex()
+    uuid = '-'.join((uuid[:8], uuid[8:12], uuid[12:16], uuid[16:20], uuid[20:]))
+    label = data[0x78:0x88].split(b'\0')[0].decode('utf-8', 'replace')
+    # the free count is updated lazily while the filesystem is mounted, close enough
+    # here; the blocks reserved for root are not free for users, as in df
+    return Superblock(fstype, label, uuid, blocks * block_size,
+                      max(0, free - reserved) * block_size, generation=generation)
+
+
+def read_superblock(path):
+    ''' The Superblock of the filesystem on path, None if there is none '''
+    superblock = read_ext_superblock(path)
+    if superblock is not None:
+        return superblock
+    # -p reads the device itself instead of the blkid cache
+    result = commands.run(['blkid', '-p', '-o', 'export', path], log=False)
+    if not result.ok:
+        return None
+    values = dict(line.split('=', 1) for line in result.output.splitlines() if '=' in line)
+    if 'TYPE' not in values:
+        return None
+    return Superblock(values['TYPE'], values.get('LABEL', ''), values.get('UUID', ''),
+                      usage=values.get('USAGE', 'filesystem'))
+
+
+def release_name(lines, key):
+    for line in lines:
+        if line.startswith(key + '='):
+            return line.split('=', 1)[1].strip().strip('"\'')
+    return None
+
+
+def ext_os_description(path):
+    ''' Name of the OS on the ext2/3/4 filesystem on path, read with debugfs without mounting it '''
+    # 'Unix' when there is an /etc but no release file, '' when there is no /etc,
+    # None when debugfs could not be run or could not open the filesystem
+    requests = ['cat /%s' % name for name, _ in RELEASE_FILES] + ['stat /etc']
+    result = commands.run(['debugfs', '-f', '-', path], input='\n'.join(requests) + '\n',
+                          env={'DEBUGFS_PAGER': '__none__'}, log=False)
+    if result.status is None:
+        return None
+    replies = {}
+    request = None
+    for line in result.output.splitlines():
+        if line.startswith('debugfs: '):
+            request = line[len('debugfs: '):].strip()
+            replies[request] = []
+        elif request is not None:
+            replies[request].append(line)
+    for name, key in RELEASE_FILES:
+        description = release_name(replies.get('cat /' + name, []), key)
+        if description:
+            return description
+    if any(line.startswith('Inode:') for line in replies.get('stat /etc', [])):
+        return 'Unix'
+    # debugfs exits with 0 also when it could not open the filesystem; only
+    # a lookup that failed says there is no /etc
+    if any(line.startswith('/etc: File not found') for line in result.error.splitlines()):
+        return ''
+    return None
+
+
+def os_description(root):
+    ''' Name of the OS installed in the directory root, None if there is no /etc '''
+    if not os.path.isdir(os.path.join(root, 'etc')):
+        return None
+    for name, key in RELEASE_FILES:
+        path = os.path.join(root, name)
+        if os.path.islink(path) and os.path.isabs(os.readlink(path)):
+            # would point into the live system
+            continue
+        try:
+            with open(path) as f:
+                description = release_name(f.read().splitlines(), key)
+        except (OSError, UnicodeDecodeError):
+            continue
+        if description:
+            return description
+    return 'Unix'
+
+
+def read_only_options(fstype):
+    return READ_ONLY_OPTIONS.get(fstype, 'ro')
+
+
+def usage(path):
+    ''' (size, free) of the filesystem mounted on path in bytes, free as df shows it '''
+    st = os.statvfs(path)
+    return st.f_blocks * st.f_frsize, st.f_bavail * st.f_frsize
+
+
+def full_disk_format(device, create_boot=False, create_swap=True, format_root=True, gptonefi=False):
+    # Create a default partition set up
+    disk_label = ('gpt' if device.getLength('B') > 2**32*.9 * device.sectorSize  # size of disk > ~2TB
+                  or gptonefi
+                  else 'msdos')
+    if not commands.run(["parted", "-s", device.path, "mklabel", disk_label]).ok:
+        raise Exception(
+            ("The partition table couldn't be written for %s. Restart the computer and try again.") % device.path)
+
+    mkpart = (
+        # (condition, mount_as, format_as, mkfs command, size_mb)
+        # EFI
+        (gptonefi, EFI_MOUNT_POINT,
+         'vfat', ['mkfs.vfat', '{}', '-F', '32'], 300),
+        # boot
+        (create_boot, '/boot', 'ext4', ['mkfs.ext4', '-F', '{}'], 1024),
+        # swap - equal to RAM for hibernate to work well (but capped at ~8GB)
+        (create_swap, SWAP_MOUNT_POINT, 'swap', ['mkswap', '{}'], min(8800, int(round(
+            1.1/1024 * memory_kb(), -2)))),
+        # root (left unformatted when an image is deployed on it)
+        (True, '/', 'ext4', ['mkfs.ext4', '-F', '{}'] if format_root else None, 0),
+    )
+    def run_parted(cmd):
+        result = commands.run(['parted', '--script', '--align', 'optimal', device.path] + cmd)
+        os.sync()
+        return result
+    start_mb = 2
+    partition_number = 0
+    # the filesystems are made once parted is done with the disk
+    formats = []
+    for partition in mkpart:
+        if partition[0]:
+            partition_number = partition_number + 1
+            mkfs = partition[3]
+            size_mb = partition[4]
+            end = '{}MB'.format(start_mb + size_mb) if size_mb else '100%'
+            run_parted(['mkpart', 'primary', '{}MB'.format(start_mb), end])
+            partition_path = get_partition_path(device.path, partition_number)
+            num_tries = 0
+            while True:
+                if os.path.exists(partition_path) or (dryrun.plan is not None and dryrun.plan.created(partition_path)):
+                    break
+                if num_tries < 5:
+                    num_tries += 1
+                    print(("Could not find %s, waiting 1s..." % partition_path))
+                    os.sync()
+                    time.sleep(1)
+                else:
+                    raise Exception(
+                        ("The partition %s could not be created. The installation will stop. Restart the computer and try again.") % partition_path)
+            if mkfs:
+                formats.append([arg.format(partition_path) for arg in mkfs])
+            start_mb += size_mb + 1
+    if gptonefi:
+        run_parted(['set', '1', 'boot', 'on'])
+    for result in commands.run_batch(formats):
+        if not result.ok:
+            print(result)
+    return ((i[1], i[2]) for i in mkpart if i[0])
+
+
+def deploy_image(image, partition_path, progresshook=None):
+    ''' Stream a filesystem image to a partition and grow it to fill the partition '''
+    if dryrun.plan is not None:
+        dryrun.plan.write(image, partition_path, os.path.getsize(image))
+    else:
+        write_image(image, partition_path, progresshook)
+    # resize2fs and tune2fs -U want a freshly checked filesystem (e2fsck exits
+    # with 1 when it corrected something), a new UUID keeps installs made from
+    # the same image apart
+    for cmd, max_status in ((["e2fsck", "-f", "-y"], 1),
+                            (["tune2fs", "-U", "random"], 0),
+                            (["resize2fs"], 0)):
+        result = commands.run(cmd + [partition_path])
+        if result.status is None or result.status > max_status:
+            raise Exception(("'%s' failed.") % result)
+
+
+# ioctl to zero a byte range of a block device, _IO(0x12, 127)
+BLKZEROOUT = 0x127f
+# zeros written at a time where BLKZEROOUT can't be used
+ZERO_CHUNK = 1024 * 1024
+
+
+def zero_range(fd, offset, length, is_block):
+    ''' Make length bytes at offset of fd read as zeros '''
+    if is_block:
+        try:
+            # the kernel offloads this to disks that support it and writes zeros otherwise
+            fcntl.ioctl(fd, BLKZEROOUT, struct.pack('QQ', offset, length))
+            return
+        except OSError as detail:
+            print("BLKZEROOUT failed, writing zeros: %s" % detail)
+    zeros = bytes(ZERO_CHUNK)
+    end = offset + length
+    while offset < end:
+        offset += os.pwrite(fd, zeros[:min(ZERO_CHUNK, end - offset)], offset)
+
+
+def write_image(image, partition_path, progresshook=None):
+    ''' Copy an image to a partition '''
+    # Only the data extents of the image are read. The holes are zeroed on the
+    # partition: e2image also makes holes of used blocks that are all zeros
+    # (inode tables, bitmaps, file data), what the partition had there before
+    # must not show through.
+    image_fd = os.open(image, os.O_RDONLY)
+    try:
+        size = os.fstat(image_fd).st_size
+        device_fd = os.open(partition_path, os.O_WRONLY)
+        try:
+            device_size = os.lseek(device_fd, 0, os.SEEK_END)
+            if size > device_size:
+                raise Exception(("The partition %s is too small for the system image (%s needed).") % (
+                    partition_path, to_human_readable(size)))
+            is_block = stat.S_ISBLK(os.fstat(device_fd).st_mode)
+            offset = 0
+            while offset < size:
+                try:
+                    data = os.lseek(image_fd, offset, os.SEEK_DATA)
+                    hole = min(os.lseek(image_fd, data, os.SEEK_HOLE), size)
+                except OSError as detail:
+                    if detail.errno != errno.ENXIO:
+                        raise
+                    data = hole = size  # trailing hole
+                if data > offset:
+                    zero_range(device_fd, offset, data - offset, is_block)
+                os.lseek(device_fd, data, os.SEEK_SET)
+                while data < hole:
+                    written = os.sendfile(
+                        device_fd, image_fd, data, min(hole - data, 8 * 1024 * 1024))
+                    if written == 0:
+                        break
+                    data += written
+                    if progresshook is not None:
+                        progresshook(data, size)
+                offset = hole
+            os.fsync(device_fd)
+        finally:
+            os.close(device_fd)
+    finally:
+        os.close(image_fd)
+
+
+
+def memory_kb():
+    ''' Size of the RAM in kB '''
+    with open('/proc/meminfo') as meminfo:
+        for line in meminfo:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1])
+    return 0
+
+
+def to_human_readable(size):
+    for unit in [' ', ('kB'), ('MB'), ('GB'), ('TB'), 'PB', 'EB', 'ZB', 'YB']:
+        if size < 1000:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1000
@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+# Dry run: the installer goes through every step, but the commands, mounts,
+# chroot commands, the file copy and image writes are recorded instead of
+# run. The result is the ordered plan of what an installation would do, with
+# an estimate of how long each operation takes.
+#
+# Files the steps write themselves (fstab, locale, users...) go to a tmpfs
+# on /target in a mount namespace of this process, so nothing outside it
+# changes. The mounts the installer makes are kept in a simulated mount
+# table, and the partitions parted would create are simulated devices.
+#
+#     live-installer-headless --dry-run preseed.json
+
+import errno
+import os
+import shlex
+import shutil
+import stat
+import threading
+import time
+
+# Estimated seconds of a command, by program
+COSTS = {
+    'parted': 0.5,
+    'mkfs.ext2': 3.0,
+    'mkfs.ext3': 3.0,
+    'mkfs.ext4': 3.0,
+    'mkfs.btrfs': 1.0,
+    'mkfs.xfs': 1.0,
+    'mkfs.jfs': 1.0,
+    'mkfs.vfat': 0.5,
+    'mkswap': 0.3,
+    'udevadm': 0.2,
+    'blkid': 0.05,
+    'btrfs': 0.2,
+}
+# Estimated seconds of a command run in the chroot, by program
+CHROOT_COSTS = {
+    'grub-install': 5.0,
+    'grub-mkconfig': 10.0,
+    '/tmp/script.sh': 2.0,
+}
+DEFAULT_COST = 0.1
+MOUNT_COST = 0.01
+# Bytes per second of the file copy, image writes and badblocks
+COPY_RATE = 80 * 1024 * 1024
+WRITE_RATE = 150 * 1024 * 1024
+BADBLOCKS_RATE = 60 * 1024 * 1024
+# Installed size / squashfs size, when there is no manifest
+SQUASHFS_RATIO = 2.5
+# Directories the steps after the copy write into
+TARGET_DIRS = ['etc/env.d', 'etc/conf.d', 'etc/X11/xorg.conf.d', 'boot/grub',
+               'home', 'tmp', 'var/log', 'data', 'dev', 'proc', 'sys', 'run']
+
+# The Plan being recorded, None when installing for real
+plan = None
+
+
+def device_size(path):
+    ''' Size of a block device in bytes, 0 if it is not one '''
+    name = os.path.basename(os.path.realpath(path))
+    try:
+        with open('/sys/class/block/%s/size' % name) as f:
+            return int(f.read()) * 512
+    except (OSError, ValueError):
+        return 0
+
+
+class Step(object):
+    ''' One recorded operation '''
+
+    def __init__(self, kind, description, cost, note=None):
+        self.kind = kind
+        self.description = description
+        self.cost = cost
+        self.note = note
+        self.thread = threading.current_thread().name
+
+    def as_dict(self):
+        step = {'kind': self.kind, 'description': self.description,
+                'cost': round(self.cost, 3), 'thread': self.thread}
+        if self.note:
+            step['note'] = self.note
+        return step
+
+
+class Plan(object):
+    ''' The operations of a dry run, and the disks and mounts they would leave behind '''
+
+    def __init__(self):
+        self.steps = []
+        self.lock = threading.Lock()
+        # disk -> number of partitions created on it
+        self.partitions = {}
+        # simulated device -> filesystem it was formatted with
+        self.filesystems = {}
+        # (mount id, parent id, mount point), like mounts.mount_table()
+        self.table = []
+        self.next_id = 1
+        self.started = time.monotonic()
+
+    def record(self, kind, description, cost, note=None):
+        with self.lock:
+            self.steps.append(Step(kind, description, cost, note))
+
+    def created(self, path):
+        ''' Whether the recorded commands would have created the device path '''
+        with self.lock:
+            return path in self.filesystems
+
+    def command(self, argv):
+        ''' Record argv (commands.run), returns (status, output) '''
+        import devices
+        program = os.path.basename(argv[0])
+        cost = COSTS.get(program, DEFAULT_COST)
+        note = None
+        with self.lock:
+            if program == 'parted' and 'mklabel' in argv:
+                self.partitions[argv[argv.index('mklabel') - 1]] = 0
+            elif program == 'parted' and 'mkpart' in argv:
+                disk = next(arg for arg in argv[1:] if arg.startswith('/dev/'))
+                self.partitions[disk] = self.partitions.get(disk, 0) + 1
+                path = devices.get_partition_path(disk, self.partitions[disk])
+                self.filesystems.setdefault(path, None)
+                note = "creates %s" % path
+            elif program.startswith('mkfs.') or program == 'mkswap':
+                device = next((arg for arg in argv[1:] if arg.startswith('/dev/')), None)
+                if device is not None:
+                    self.filesystems[device] = program[5:] if program != 'mkswap' else 'swap'
+            elif program == 'badblocks':
+                cost = device_size(argv[-1]) * 2 / BADBLOCKS_RATE
+        self.record('command', shlex.join(argv), cost, note)
+        return 0, ''
+
+    def chroot(self, root, command):
+        ''' Record a command run inside root, returns (status, output) '''
+        words = command.split()
+        self.record('chroot', command, CHROOT_COSTS.get(words[0] if words else '', DEFAULT_COST))
+        if words[:1] == ['grub-mkconfig'] and '-o' in words:
+            # the configuration is checked afterwards
+            path = os.path.join(root, words[words.index('-o') + 1].lstrip('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write("# written by a dry run\n")
+        return 0, ''
+
+    def mount(self, source, target, fstype, flags, data):
+        ''' Record mount(2) in the simulated mount table '''
+        target = os.path.realpath(target)
+        note = None
+        if source is None or flags & 32:
+            # propagation change or MS_REMOUNT of an existing mount
+            self.record('mount', "%s (flags=%#x)" % (target, flags), MOUNT_COST)
+            return
+        with self.lock:
+            if source in self.filesystems and self.filesystems[source] is None:
+                note = "%s is not formatted" % source
+            parents = [entry for entry in self.table if target.startswith(entry[2].rstrip('/') + '/')]
+            parent = max(parents, key=lambda entry: len(entry[2]))[0] if parents else 0
+            self.table.append((self.next_id, parent, target))
+            self.next_id += 1
+        options = ','.join(option for option in [data, 'flags=%#x' % flags if flags else None] if option)
+        self.record('mount', "%s on %s (%s%s)" % (source, target, fstype or 'bind',
+                                                 ', ' + options if options else ''),
+                    MOUNT_COST, note)
+
+    def umount(self, target, flags):
+        ''' Record umount2(2), raises OSError like it if target is not mounted '''
+        target = os.path.realpath(target)
+        with self.lock:
+            entries = [entry for entry in self.table if entry[2] == target]
+            if not entries:
+                raise OSError(errno.EINVAL, "Could not unmount %s: %s" %
+                              (target, os.strerror(errno.EINVAL)))
+            self.table.remove(entries[-1])
+        self.record('umount', target, MOUNT_COST)
+
+    def mount_table(self):
+        with self.lock:
+            return list(self.table)
+
+    def copy(self, source, dest, manifest=None, media=None):
+        ''' Record the copy of the live system, and lay out the target so the later steps work '''
+        if manifest is not None:
+            size = manifest.total_size
+            for index in range(len(manifest)):
+                if stat.S_ISDIR(manifest.modes[index]):
+                    os.makedirs(os.path.join(dest, manifest.path(index)), exist_ok=True)
+            note = "%d entries" % len(manifest)
+        else:
+            size = int(device_size(media) * SQUASHFS_RATIO) if media else 0
+            note = "size estimated from %s" % media
+        for path in TARGET_DIRS:
+            os.makedirs(os.path.join(dest, path), exist_ok=True)
+        # the live system's /etc stands in for the one of the medium, the steps edit it
+        try:
+            shutil.copytree('/etc', os.path.join(dest, 'etc'), symlinks=True, dirs_exist_ok=True)
+        except shutil.Error as detail:
+            print("Some files of /etc were not copied: %d errors" % len(detail.args[0]))
+        try:
+            strip_users(dest)
+        except OSError as detail:
+            print("Could not remove the users of this system from %s: %s" % (dest, detail))
+        self.record('copy', "%s to %s, %.1f MB" % (source, dest, size / 1024 / 1024),
+                    size / COPY_RATE, note)
+
+    def write(self, image, device, size):
+        ''' Record writing an image to a device '''
+        with self.lock:
+            self.filesystems[device] = 'image'
+        self.record('write', "%s to %s, %.1f MB" % (image, device, size / 1024 / 1024),
+                    size / WRITE_RATE)
+
+    def estimated(self):
+        return sum(step.cost for step in self.steps)
+
+    def as_dict(self):
+        return {'steps': [step.as_dict() for step in self.steps],
+                'estimated_seconds': round(self.estimated(), 1),
+                'python_seconds': round(time.monotonic() - self.started, 3)}
+
+    def report(self):
+        ''' Print the plan '''
+        for number, step in enumerate(self.steps, 1):
+            print("%4d %8.2fs  %-7s %s%s" % (number, step.cost, step.kind, step.description,
+                                            "  (%s)" % step.note if step.note else ""))
+        print("%d operations, about %.0fs; the dry run itself took %.2fs" % (
+            len(self.steps), self.estimated(), time.monotonic() - self.started))
+
+
+def strip_users(root):
+    ''' Remove the regular users and groups of the copied /etc, the live medium has none '''
+    # otherwise a user of the system running the dry run could not be added again
+    import accounts
+    users = accounts.Accounts(root)
+    defs = users.login_defs
+    regular = set(entry[0] for entry in users.database('passwd') if entry[2].isdigit() and
+                  int(defs['UID_MIN']) <= int(entry[2]) <= int(defs['UID_MAX']))
+    groups = set(entry[0] for entry in users.database('group') if entry[2].isdigit() and
+                 int(defs['GID_MIN']) <= int(entry[2]) <= int(defs['GID_MAX']))
+    for name in accounts.DATABASES:
+        entries = users.database(name)
+        if entries is None:
+            continue
+        removed = regular if name in ('passwd', 'shadow') else groups
+        entries[:] = [entry for entry in entries if entry[0] not in removed]
+        if name in ('group', 'gshadow'):
+            for entry in entries:
+                entry[3] = ','.join(member for member in entry[3].split(',')
+                                    if member and member not in regular)
+        users.changed.add(name)
+    users.save()
+    print("Removed %d users and %d groups of this system from %s" % (len(regular), len(groups), root))
+
+
+def start():
+    ''' Start recording; /target and /source become scratch tmpfs mounts of this process only '''
+    # before any thread is started, threads started later share the namespace
+    global plan
+    import mounts
+    mounts.private_namespace()
+    for path in ['/target', '/source']:
+        os.makedirs(path, exist_ok=True)
+        mounts.mount('tmpfs', path, 'tmpfs', 0, 'mode=0755')
+    plan = Plan()
+    return plan
@@ -7,8 +7,9 @@ import timezones
 import partitioning
 import os
 import re
-import subprocess
 import sys
+import commands
+import tracing
 import threading
 import time
 import parted
@@ -19,6 +20,17 @@ gi.require_version('Gtk', '3.0')
 
 
 LOADING_ANIMATION = './resources/loading.gif'
+# How often the install page picks up the latest progress, in frames per second
+PROGRESS_FPS = 30
+
+def isoquery(iso_standard, column):
+    ''' isoquery output as `isoquery | cut -f<column>,4-` would print it '''
+    lines = []
+    for line in commands.output(["isoquery", "--iso", iso_standard]).split('\n'):
+        cols = line.split('\t')
+        lines.append('\t'.join([cols[column - 1]] + cols[3:]) if len(cols) >= column else line)
+    return lines
+
 
 # Used as a decorator to run things in the background
 
@@ -40,6 +52,25 @@ def idle(func):
     return wrapper
 
 
+class ProgressSlot:
+    ''' Holds the latest progress update from the install thread until the GUI samples it '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._update = None
+
+    def put(self, update):
+        with self._lock:
+            # a finished installation must not be hidden by a late update
+            if self._update is None or not self._update[3]:
+                self._update = update
+
+    def take(self):
+        with self._lock:
+            update, self._update = self._update, None
+        return update
+
+
 class WizardPage:
 
     def __init__(self, help_text, icon, question):
@@ -59,10 +90,12 @@ class InstallerWindow:
         self.expert_mode = expert_mode
 
         # disable the screensaver
-        os.system("killall cinnamon-screen")
+        commands.run(["killall", "cinnamon-screen"])
 
         # build the setup object (where we put all our choices) and the installer
         self.setup = Setup()
+        if os.path.exists(partitioning.ROOT_IMAGE):
+            self.setup.image = partitioning.ROOT_IMAGE
         self.installer = InstallerEngine(self.setup)
 
         self.resource_dir = './resources/'
@@ -249,6 +282,7 @@ class InstallerWindow:
 
         # build partition list
         self.should_pulse = False
+        self.progress_slot = ProgressSlot()
 
         # make sure we're on the right page (no pun.)
         self.activate_page(0)
@@ -515,6 +549,7 @@ class InstallerWindow:
     def show_customwarning(self, widget):
         self.activate_page(self.PAGE_CUSTOMWARNING)
 
+    @tracing.traced(category='gui')
     def build_lang_list(self):
 
         # Try to find out where we're located...
@@ -541,7 +576,7 @@ class InstallerWindow:
         iso_standard = "3166"
         if os.path.exists("/usr/share/xml/iso-codes/iso_3166-1.xml"):
             iso_standard = "3166-1"
-        for line in subprocess.getoutput("isoquery --iso %s | cut -f1,4-" % iso_standard).split('\n'):
+        for line in isoquery(iso_standard, 1):
             ccode, cname = line.split(None, 1)
             countries[ccode] = cname
 
@@ -550,12 +585,12 @@ class InstallerWindow:
         iso_standard = "639"
         if os.path.exists("/usr/share/xml/iso-codes/iso_639-2.xml"):
             iso_standard = "639-2"
-        for line in subprocess.getoutput("isoquery --iso %s | cut -f3,4-" % iso_standard).split('\n'):
+        for line in isoquery(iso_standard, 3):
             cols = line.split(None, 1)
             if len(cols) > 1:
                 name = cols[1].replace(";", ",")
                 languages[cols[0]] = name
-        for line in subprocess.getoutput("isoquery --iso %s | cut -f1,4-" % iso_standard).split('\n'):
+        for line in isoquery(iso_standard, 1):
             cols = line.split(None, 1)
             if len(cols) > 1:
                 if cols[0] not in list(languages.keys()):
@@ -571,7 +606,9 @@ class InstallerWindow:
         language = None
         flag = memoize(
             lambda ccode: GdkPixbuf.Pixbuf.new_from_file(flag_path(ccode)))
-        for locale in subprocess.getoutput("cat ./resources/locales").split('\n'):
+        with open("./resources/locales") as localesfh:
+            locales = localesfh.read().strip().split('\n')
+        for locale in locales:
             if '_' in locale:
                 lang, ccode = locale.split('_')
                 language = lang
@@ -610,11 +647,14 @@ class InstallerWindow:
             treeview.set_cursor(path)
             treeview.scroll_to_cell(path)
 
+    @tracing.traced(category='gui')
     def build_kb_lists(self):
         ''' Do some xml kung-fu and load the keyboard stuffs '''
         # Determine the layouts in use
+        query = dict(line.split(':', 1) for line in commands.output(
+            ["setxkbmap", "-query"]).split('\n') if ':' in line)
         (keyboard_geom,
-         self.setup.keyboard_layout) = subprocess.getoutput("setxkbmap -query | awk '/^(model|layout)/{print $2}'").split()
+         self.setup.keyboard_layout) = query['model'].strip(), query['layout'].strip()
         # Build the models
         from collections import defaultdict
 
@@ -710,7 +750,7 @@ class InstallerWindow:
         active = combobox.get_active()
         (self.setup.keyboard_model_description,
          self.setup.keyboard_model) = model[active]
-        os.system('setxkbmap -model ' + self.setup.keyboard_model)
+        commands.run(['setxkbmap', '-model', self.setup.keyboard_model])
         self.setup.print_setup()
 
     def assign_keyboard_layout(self, treeview):
@@ -756,9 +796,8 @@ class InstallerWindow:
         else:
             self.builder.get_object("label_non_latin").hide()
 
-        command = "setxkbmap -layout '%s' -variant '%s' -option grp:ctrls_toggle" % (
-            self.setup.keyboard_layout, self.setup.keyboard_variant)
-        os.system(command)
+        commands.run(["setxkbmap", "-layout", self.setup.keyboard_layout,
+                      "-variant", self.setup.keyboard_variant, "-option", "grp:ctrls_toggle"])
         self.setup.print_setup()
 
         # Remove preview image
@@ -1018,6 +1057,7 @@ class InstallerWindow:
                 self.builder.get_object("button_next").set_sensitive(False)
                 self.builder.get_object("button_back").set_sensitive(False)
                 self.builder.get_object("button_quit").set_sensitive(False)
+                GObject.timeout_add(1000 // PROGRESS_FPS, self.show_progress)
                 self.do_install()
                 self.builder.get_object("title_eventbox").hide()
                 self.builder.get_object("button_eventbox").hide()
@@ -1042,8 +1082,11 @@ class InstallerWindow:
                     self.activate_page(self.PAGE_TYPE)
                 else:
                     self.activate_page(self.PAGE_PARTITIONS)
+                    # the page keeps its model, catch up with the disks that changed
+                    partitioning.refresh_dirty_disks()
             elif(sel == self.PAGE_CUSTOMWARNING):
                 self.activate_page(self.PAGE_PARTITIONS)
+                partitioning.refresh_dirty_disks()
             elif(sel == self.PAGE_PARTITIONS):
                 self.activate_page(self.PAGE_TYPE)
             elif(sel == self.PAGE_TYPE):
@@ -1106,7 +1149,7 @@ class InstallerWindow:
         if self.showing_last_dialog:
             self.showing_last_dialog = False
         if reboot:
-            os.system('reboot')
+            commands.run(['reboot'])
 
     @idle
     def pause_installation(self):
@@ -1144,6 +1187,9 @@ class InstallerWindow:
         if self.critical_error_happened:
             self.show_error_dialog(
                 ("Installation error"), self.critical_error_message)
+            if do_try_finish_install:
+                # finish_installation won't run and unmount what was mounted
+                self.installer.unmount_target(False)
             do_try_finish_install = False
 
         if do_try_finish_install:
@@ -1158,6 +1204,8 @@ class InstallerWindow:
             except Exception as detail1:
                 print(detail1)
                 self.show_error_dialog(("Installation error"), str(detail1))
+            # before the reboot dialog
+            tracing.save()
 
             # show a message dialog thingum
             while(not self.done):
@@ -1175,6 +1223,7 @@ class InstallerWindow:
 
             print(" ## INSTALLATION COMPLETE ")
 
+        tracing.save()
         Gtk.main_quit()
         sys.exit(0)
 
@@ -1182,8 +1231,19 @@ class InstallerWindow:
         self.critical_error_happened = True
         self.critical_error_message = message
 
-    @idle
     def update_progress(self, current, total, pulse, done, message):
+        # called for every copied file, only the latest state is kept for show_progress
+        self.progress_slot.put((current, total, pulse, done, message))
+
+    def show_progress(self):
+        update = self.progress_slot.take()
+        if update is None:
+            return True
+        current, total, pulse, done, message = update
+        self.set_progress(current, total, pulse, done, message)
+        return not done
+
+    def set_progress(self, current, total, pulse, done, message):
         if(pulse):
             self.builder.get_object(
                 "label_install_progress").set_label(message)
@@ -0,0 +1,345 @@
+#!/usr/bin/python3
+# Unattended installation driven by a preseed file, no display needed:
+#
+#     live-installer-headless preseed.json
+#     live-installer-headless --validate preseed.json
+#     live-installer-headless --dry-run preseed.json
+#
+# The preseed is a JSON object:
+#
+#     {
+#         "disk": "/dev/sda",
+#         "language": "tr_TR",
+#         "timezone": "Europe/Istanbul",
+#         "keyboard": {"model": "pc105", "layout": "tr", "variant": ""},
+#         "user": {"username": "ali", "real_name": "Ali", "password": "...",
+#                  "autologin": false},
+#         "hostname": "ali-pc",
+#         "grub_device": "/dev/sda"
+#     }
+#
+# Optional keys: "image" (filesystem image for the root partition, defaults
+# to the one on the live medium if there is one, null to copy files),
+# "badblocks", "copy_with_rsync", and "skip_mount" (install to a /target
+# that is already mounted instead of partitioning "disk"). "grub_device"
+# may be null to leave the bootloader alone.
+#
+# Instead of "disk", "partitions" installs to existing partitions, like the
+# partition page does; "format" is null (or left out) to keep what is there:
+#
+#     "partitions": [
+#         {"path": "/dev/sda1", "mountpoint": "swap", "format": "swap"},
+#         {"path": "/dev/sda2", "mountpoint": "/", "format": "ext4"},
+#         {"path": "/dev/sdb1", "mountpoint": "/home", "format": null}
+#     ]
+#
+# Progress goes to stdout as one JSON object per line:
+#
+#     {"event": "progress", "current": 3, "total": 9, "pulse": false, "message": "..."}
+#     {"event": "error", "message": "..."}
+#     {"event": "finished", "success": true, "seconds": 312.4}
+#
+# --dry-run goes through the installation without touching the disks (see
+# dryrun.py) and adds {"event": "plan", "steps": [...], ...} before finished.
+#
+# Everything the installer logs goes to stderr.
+
+import json
+import os
+import re
+import stat
+import sys
+import time
+
+if not os.path.isfile("installer.py"):
+    os.chdir("/usr/lib/live-installer")
+sys.path.insert(1, '/usr/lib/live-installer')
+
+import parted
+
+import devices
+import dryrun
+import tracing
+from installer import InstallerEngine, Setup
+
+# key: (type, required)
+PRESEED_KEYS = {
+    'disk': (str, False),
+    'partitions': (list, False),
+    'image': (str, False),
+    'badblocks': (bool, False),
+    'copy_with_rsync': (bool, False),
+    'skip_mount': (bool, False),
+    'language': (str, True),
+    'timezone': (str, True),
+    'keyboard': (dict, True),
+    'user': (dict, True),
+    'hostname': (str, True),
+    'grub_device': (str, True),
+}
+KEYBOARD_KEYS = {
+    'model': (str, True),
+    'layout': (str, True),
+    'variant': (str, False),
+}
+PARTITION_KEYS = {
+    'path': (str, True),
+    'mountpoint': (str, True),
+    'format': (str, False),
+}
+# what installer.get_format_command() can make
+FORMATS = ['ext2', 'ext3', 'ext4', 'btrfs', 'xfs', 'jfs', 'vfat', 'swap']
+USER_KEYS = {
+    'username': (str, True),
+    'real_name': (str, False),
+    'password': (str, True),
+    'autologin': (bool, False),
+}
+# These may be null
+NULLABLE = ['image', 'grub_device', 'format']
+
+USERNAME = re.compile(r'^[a-z_][a-z0-9_-]{0,31}$')
+HOSTNAME = re.compile(r'^[a-zA-Z0-9]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?$')
+# Progress lines are written at most this often, except for the last one
+PROGRESS_INTERVAL = 0.25
+
+
+def check_keys(values, keys, where, errors):
+    for key in values:
+        if key not in keys:
+            errors.append("%s: unknown key '%s'" % (where, key))
+    for key, (kind, required) in keys.items():
+        if key not in values:
+            if required:
+                errors.append("%s: '%s' is missing" % (where, key))
+        elif values[key] is None:
+            if key not in NULLABLE:
+                errors.append("%s: '%s' can not be null" % (where, key))
+        elif not isinstance(values[key], kind):
+            errors.append("%s: '%s' must be a %s" % (where, key, kind.__name__))
+
+
+def is_block_device(path):
+    try:
+        return stat.S_ISBLK(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+def validate(preseed):
+    ''' Return the problems of a preseed, an empty list if it can be installed '''
+    errors = []
+    if not isinstance(preseed, dict):
+        return ["the preseed must be a JSON object"]
+    check_keys(preseed, PRESEED_KEYS, 'preseed', errors)
+    if isinstance(preseed.get('keyboard'), dict):
+        check_keys(preseed['keyboard'], KEYBOARD_KEYS, 'keyboard', errors)
+    if isinstance(preseed.get('user'), dict):
+        check_keys(preseed['user'], USER_KEYS, 'user', errors)
+    for number, partition in enumerate(preseed.get('partitions') or []):
+        if not isinstance(partition, dict):
+            errors.append("partitions[%d]: must be a JSON object" % number)
+        else:
+            check_keys(partition, PARTITION_KEYS, 'partitions[%d]' % number, errors)
+    if errors:
+        return errors
+
+    if len([key for key in ('disk', 'partitions', 'skip_mount') if preseed.get(key)]) > 1:
+        errors.append("preseed: only one of 'disk', 'partitions' and 'skip_mount' can be used")
+    elif preseed.get('skip_mount'):
+        if not os.path.ismount('/target'):
+            errors.append("skip_mount is set but nothing is mounted on /target")
+    elif 'partitions' in preseed:
+        validate_partitions(preseed['partitions'], errors)
+    elif 'disk' not in preseed:
+        errors.append("preseed: 'disk' is missing")
+    elif not is_block_device(preseed['disk']):
+        errors.append("disk: %s is not a block device" % preseed['disk'])
+    if preseed.get('image') is not None and not os.path.isfile(preseed['image']):
+        errors.append("image: %s does not exist" % preseed['image'])
+    if preseed['grub_device'] is not None and not is_block_device(preseed['grub_device']):
+        errors.append("grub_device: %s is not a block device" % preseed['grub_device'])
+    if not os.path.isfile(os.path.join('/usr/share/zoneinfo', preseed['timezone'])):
+        errors.append("timezone: unknown timezone %s" % preseed['timezone'])
+    if not preseed['language']:
+        errors.append("language: can not be empty")
+    if not HOSTNAME.match(preseed['hostname']):
+        errors.append("hostname: %s is not a valid host name" % preseed['hostname'])
+    user = preseed['user']
+    if not USERNAME.match(user['username']):
+        errors.append("user: %s is not a valid user name" % user['username'])
+    if not user['password']:
+        errors.append("user: the password can not be empty")
+    return errors
+
+
+def validate_partitions(partitions, errors):
+    mountpoints = []
+    for number, partition in enumerate(partitions):
+        where = 'partitions[%d]' % number
+        if not is_block_device(partition['path']):
+            errors.append("%s: %s is not a block device" % (where, partition['path']))
+        elif not os.path.exists('/sys/class/block/%s/partition' %
+                                os.path.basename(os.path.realpath(partition['path']))):
+            errors.append("%s: %s is not a partition" % (where, partition['path']))
+        mountpoint = partition['mountpoint']
+        if mountpoint != devices.SWAP_MOUNT_POINT and not mountpoint.startswith('/'):
+            errors.append("%s: %s is not a mount point" % (where, mountpoint))
+        elif mountpoint in mountpoints and mountpoint != devices.SWAP_MOUNT_POINT:
+            errors.append("%s: %s is used twice" % (where, mountpoint))
+        mountpoints.append(mountpoint)
+        if partition.get('format') is not None and partition['format'] not in FORMATS:
+            errors.append("%s: can not format as %s, only as %s" % (
+                where, partition['format'], ', '.join(FORMATS)))
+        elif partition.get('format') is None and mountpoint in ('/', '/@') and \
+                devices.read_superblock(partition['path']) is None:
+            errors.append("%s: there is no filesystem on %s, set 'format'" % (where, partition['path']))
+    if len([mountpoint for mountpoint in mountpoints if mountpoint in ('/', '/@')]) != 1:
+        errors.append("partitions: exactly one partition must be mounted on / (or /@)")
+
+
+class PresetPartition(object):
+    ''' The parts of partitioning.Partition the installer engine uses, for a partition of the preseed '''
+
+    def __init__(self, path, mount_as, format_as):
+        self.path = path
+        self.name = path
+        self.mount_as = mount_as
+        self.format_as = format_as or ''
+        # what is on it now, it is mounted like that unless it gets formatted
+        superblock = devices.read_superblock(path)
+        self.type = superblock.type if superblock is not None else ''
+        disk = parted.Disk(parted.getDevice(devices.disk_of(path)))
+        self.partition = next((partition for partition in disk.partitions
+                               if partition.path == os.path.realpath(path)), None)
+        if self.partition is None:
+            raise Exception("%s is not a partition of %s" % (path, devices.disk_of(path)))
+
+    def print_partition(self):
+        print("Device: %s, format as: %s, mount as: %s" %
+              (self.path, self.format_as, self.mount_as))
+
+
+def make_setup(preseed):
+    ''' The Setup the wizard would have built for these choices '''
+    setup = Setup()
+    setup.skip_mount = preseed.get('skip_mount', False)
+    setup.automated = not setup.skip_mount and 'partitions' not in preseed
+    setup.partitions = [PresetPartition(partition['path'], partition['mountpoint'],
+                                        partition.get('format'))
+                        for partition in preseed.get('partitions') or []]
+    if setup.automated:
+        setup.disk = setup.diskname = preseed['disk']
+        setup.badblocks = preseed.get('badblocks', False)
+        if 'image' in preseed:
+            setup.image = preseed['image']
+        elif os.path.exists(devices.ROOT_IMAGE):
+            setup.image = devices.ROOT_IMAGE
+    setup.gptonefi = devices.is_efi_supported()
+    setup.copy_with_rsync = preseed.get('copy_with_rsync', False)
+    setup.language = preseed['language']
+    setup.timezone = preseed['timezone']
+    keyboard = preseed['keyboard']
+    setup.keyboard_model = keyboard['model']
+    setup.keyboard_layout = keyboard['layout']
+    setup.keyboard_variant = keyboard.get('variant', '')
+    user = preseed['user']
+    setup.username = user['username']
+    setup.real_name = user.get('real_name', '')
+    setup.password1 = setup.password2 = user['password']
+    setup.autologin = user.get('autologin', False)
+    setup.hostname = preseed['hostname']
+    setup.grub_device = preseed['grub_device']
+    return setup
+
+
+class Progress(object):
+    ''' Writes the installer's progress and errors as JSON lines '''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.last = 0
+        self.errors = []
+
+    def emit(self, event, **fields):
+        fields['event'] = event
+        self.stream.write(json.dumps(fields) + '\n')
+        self.stream.flush()
+
+    def update(self, current=0, total=0, pulse=False, done=False, message=""):
+        now = time.monotonic()
+        if not done and now - self.last < PROGRESS_INTERVAL:
+            return
+        self.last = now
+        self.emit('progress', current=current, total=total, pulse=pulse,
+                  done=done, message=message)
+
+    def error(self, message=""):
+        self.errors.append(message)
+        self.emit('error', message=message)
+
+
+def main(args):
+    only_validate = '--validate' in args
+    dry_run = '--dry-run' in args
+    args = [arg for arg in args if arg not in ('--validate', '--dry-run')]
+    if len(args) != 1:
+        print("Usage: %s [--validate | --dry-run] <preseed.json>" % sys.argv[0], file=sys.stderr)
+        return 2
+    # stdout only carries progress, the installer and the commands it runs log to stderr
+    progress = Progress(os.fdopen(os.dup(sys.stdout.fileno()), 'w'))
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    try:
+        with open(args[0]) as f:
+            preseed = json.load(f)
+    except (OSError, ValueError) as detail:
+        progress.error("Could not read %s: %s" % (args[0], detail))
+        return 2
+    errors = validate(preseed)
+    for error in errors:
+        progress.error(error)
+    if errors or only_validate:
+        progress.emit('validated', success=not errors)
+        return 2 if errors else 0
+
+    plan = None
+    if dry_run:
+        try:
+            plan = dryrun.start()
+        except OSError as detail:
+            progress.error("Could not start the dry run: %s" % detail)
+            return 1
+
+    start = time.monotonic()
+    try:
+        setup = make_setup(preseed)
+    except Exception as detail:
+        progress.error(str(detail))
+        progress.emit('finished', success=False, seconds=round(time.monotonic() - start, 1))
+        return 1
+    engine = InstallerEngine(setup)
+    engine.set_progress_hook(progress.update)
+    engine.set_error_hook(progress.error)
+    try:
+        engine.start_installation()
+        if not progress.errors:
+            engine.finish_installation()
+        else:
+            # start_installation only unmounts by itself when it raises
+            engine.unmount_target(False)
+    except Exception as detail:
+        progress.error(str(detail))
+    tracing.save()
+    if plan is not None:
+        plan.report()
+        progress.emit('plan', **plan.as_dict())
+    success = not progress.errors
+    progress.emit('finished', success=success,
+                  seconds=round(time.monotonic() - start, 1))
+    return 0 if success else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,12 +1,34 @@
 import os
-import re
-import subprocess
-import time
 import shutil
 import subprocess
-import sys
+import hashlib
+import threading
 import parted
-import partitioning
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import copier
+import manifest
+import journal
+import chroot
+import accounts
+import devices
+import dryrun
+import mounts
+import commands
+import glob
+import scheduler
+import tracing
+
+
+# Built by manifest.py along with the squashfs, lists what gets copied
+MANIFEST = '/run/live/medium/live/filesystem.manifest'
+# Steps completed so far, kept on the target so a failed installation can be resumed
+JOURNAL = '/target/var/log/live-installer-journal.json'
+# Bound into /target for the chroot, with everything mounted below them
+CHROOT_MOUNTS = ['/dev', '/sys', '/proc', '/run']
+GRUB_LOG = '/var/log/live-installer-grub-output.log'
+# grub-mkconfig runs at most this many times
+GRUB_ATTEMPTS = 3
 
 
 NON_LATIN_KB_LAYOUTS = ['am', 'af', 'ara', 'ben', 'bd', 'bg', 'bn', 'bt', 'by', 'deva', 'et', 'ge', 'gh', 'gn', 'gr', 'guj', 'guru', 'id', 'il', 'iku', 'in', 'iq', 'ir', 'kan',
@@ -18,6 +40,18 @@ class InstallerEngine:
 
     def __init__(self, setup):
         self.setup = setup
+        self.image_deployed = False
+        self.manifest = None
+        self.journal = journal.Journal(JOURNAL, None)
+        self.chroot = chroot.Chroot("/target")
+        self.uuids = devices.UuidIndex()
+        # everything mounted from here on is unmounted by unmount_target()
+        self.mounts = mounts.MountRegistry()
+        if os.path.exists(MANIFEST):
+            try:
+                self.manifest = manifest.Manifest(MANIFEST)
+            except Exception as detail:
+                print("Could not load %s: %s" % (MANIFEST, detail))
 
         # Flush print when it's called
         #sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
@@ -38,6 +72,7 @@ class InstallerEngine:
         ''' Set a callback to be called on errors '''
         self.error_message = errorhook
 
+    @tracing.traced()
     def start_installation(self):
 
         # mount the media location.
@@ -51,100 +86,214 @@ class InstallerEngine:
         if(not os.path.exists("/source")):
             os.mkdir("/source")
 
-        os.system("umount --force /target/dev/shm")
-        os.system("umount --force /target/dev/pts")
-        os.system("umount --force /target/dev/")
-        os.system("umount --force /target/sys/")
-        os.system("umount --force /target/proc/")
-        os.system("umount --force /target/run/")
-
-        self.mount_source()
-        
-
-        if (not self.setup.skip_mount):
-            if self.setup.automated:
-                self.create_partitions()
-            else:
-                self.format_partitions()
-                self.mount_partitions()
-
-        self.run_preinstall()
+        try:
+            # left over from an earlier attempt
+            for error in self.unmount_chroot():
+                print(error)
+
+            self.mount_source()
+
+            if self.setup.automated and not self.setup.skip_mount:
+                # load_journal looks at the root partition too
+                self.assign_auto_partitions()
+            self.load_journal()
+            if (not self.setup.skip_mount):
+                if self.setup.automated:
+                    if not self.journal.done('format'):
+                        self.create_partitions()
+                    self.mount_auto_partitions()
+                else:
+                    if not self.journal.done('format') and not self.format_partitions():
+                        return
+                    self.mount_partitions()
+            # the journal lives on the target, these can only be recorded now
+            self.journal.mark('format')
+            self.journal.mark('mount')
+            if self.image_deployed:
+                self.journal.mark('copy')
+
+            self.run_preinstall()
         
-        # Transfer the files
-        SOURCE = "/source/"
-        DEST = "/target/"
-        EXCLUDE_DIRS = "data/* dev/* proc/* sys/* tmp/* run/* lost+found source target".split()
-        our_current = 0
-        # (Valid) assumption: num-of-files-to-copy ~= num-of-used-inodes-on-/
-        our_total = int(subprocess.getoutput(
-            "df --inodes /{src} | awk 'END{{ print $3 }}'".format(src=SOURCE.strip('/'))))
-        print(" --> {} dosyaları kopyalanıyor".format(our_total))
-        rsync_filter = ' '.join(
-            '--exclude=' + SOURCE + d for d in EXCLUDE_DIRS)
-        rsync = subprocess.Popen("rsync --verbose --archive --no-D --acls "
-                                 "--hard-links --xattrs {rsync_filter} "
-                                 "{src}* {dst}".format(src=SOURCE,
-                                                       dst=DEST, rsync_filter=rsync_filter),
-                                 shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        while rsync.poll() is None:
-            line = str(rsync.stdout.readline())
-            line = line.replace("b'", "'")
-            line = line.replace("'", "")
-            line = line.replace("\\n", "")
-            if not line:  # still copying the previous file, just wait
-                time.sleep(0.1)
+            # Transfer the files
+            SOURCE = "/source/"
+            DEST = "/target/"
+            EXCLUDE_DIRS = copier.EXCLUDE_DIRS
+            if self.journal.done('copy'):
+                print(" --> Files already copied, skipping the file copy")
+            elif dryrun.plan is not None:
+                dryrun.plan.copy(SOURCE, DEST, self.manifest, self.media)
+                self.journal.mark('copy')
+            elif self.setup.copy_with_rsync:
+                if not self.do_copy_rsync(SOURCE, DEST, EXCLUDE_DIRS):
+                    raise Exception(("The files could not be copied, rsync failed."))
+                self.journal.mark('copy')
             else:
-                our_current = min(our_current + 1, our_total)
-                self.update_progress(our_current, our_total,
-                                     False, False, ("Kopyalanıyor /%s") % line)
-        print("rsync exited with returncode: " + str(rsync.poll()))
+                self.do_copy(SOURCE, DEST, EXCLUDE_DIRS)
+
+            # Steps that are left, each one starts as soon as the ones it needs are done
+            graph = scheduler.TaskGraph(progresshook=self.report_step)
+            graph.add('chroot', self.enter_chroot,
+                      message=("Entering the system ..."))
+            # /etc/fstab, mtab and crypttab; the post-install hooks read them (initramfs)
+            graph.add('fstab', self.journaled('fstab', self.write_fstab),
+                      requires=['chroot'],
+                      message=("Writing filesystem mount information to /etc/fstab"))
+            graph.add('postinstall', self.journaled('postinstall', self.run_postinstall),
+                      requires=['fstab'], message=("Running post-install script"))
+            graph.add('user', self.journaled('user', self.add_user),
+                      requires=['postinstall'], message=("Yeni kullanıcı sisteme ekleniyor"))
+            graph.run()
+        except Exception:
+            # the mounts and chroot shells of the steps that ran must not outlive the attempt
+            self.unmount_target(False)
+            raise
+
+    def report_step(self, current, total, message):
+        self.update_progress(current, total, False, False, message)
+
+    def journaled(self, step, func):
+        ''' Wrap func so it is skipped when the journal has the step and recorded when it is done '''
+        def run():
+            if self.journal.done(step):
+                print(" --> %s already done, skipping" % step)
+                return
+            func()
+            self.journal.mark(step)
+        return run
 
-        # Steps:
-        our_total = 11
-        our_current = 0
-        # chroot
+    def enter_chroot(self):
         print(" --> Chrooting")
-        self.update_progress(our_current, our_total, False,
-                             False, ("Entering the system ..."))
-        os.system("mount --bind /dev/ /target/dev/")
-        os.system("mount --bind /dev/shm /target/dev/shm")
-        os.system("mount --bind /dev/pts /target/dev/pts")
-        os.system("mount --bind /sys/ /target/sys/")
-        os.system("mount --bind /proc/ /target/proc/")
-        os.system("mount --bind /run/ /target/run/")
-        os.system("mv /target/etc/resolv.conf /target/etc/resolv.conf.bk")
-        os.system("cp -f /etc/resolv.conf /target/etc/resolv.conf")
-
-        self.run_postinstall()
-        
-        # add new user
+        for path in CHROOT_MOUNTS:
+            # /dev/shm, /dev/pts... come along with their parent
+            self.mounts.bind_tree(path, "/target" + path)
+        if not os.path.lexists("/target/etc/resolv.conf.bk") and os.path.lexists("/target/etc/resolv.conf"):
+            os.rename("/target/etc/resolv.conf", "/target/etc/resolv.conf.bk")
+        if os.path.lexists("/target/etc/resolv.conf"):
+            os.remove("/target/etc/resolv.conf")
+        shutil.copyfile("/etc/resolv.conf", "/target/etc/resolv.conf")
+
+    @tracing.traced()
+    def load_journal(self):
+        ''' Pick up the journal of an earlier attempt with the same setup '''
+        self.journal = journal.Journal(JOURNAL, self.setup.fingerprint())
+        if self.setup.skip_mount:
+            return self.journal.load()
+        # the journal is on the root partition, have a look before anything gets
+        # formatted; it may be another system, so its journal is not replayed either
+        if not os.path.ismount("/target"):
+            if self.setup.automated:
+                root, fs = self.auto_root_partition, "ext4"
+                options = devices.read_only_options(fs)
+            else:
+                roots = [p for p in self.setup.partitions if p.mount_as in ("/", "/@")]
+                if not roots:
+                    return False
+                root, fs = roots[0].path, roots[0].type
+                options = devices.read_only_options(fs)
+                if roots[0].mount_as == "/@":
+                    options += ",subvol=@"
+            try:
+                mounts.mount_device(root, "/target", fs, options)
+            except OSError:
+                # nothing usable there (yet)
+                return False
+        resume = self.journal.load()
+        mounts.umount_tree("/target")
+        return resume
+
+    @tracing.traced()
+    def add_user(self):
         print(" --> Yeni kullanıcı ekleniyor")
-        our_current += 1
-        self.update_progress(our_current, our_total, False,
-                             False, ("Yeni kullanıcı sisteme ekleniyor"))
         #TODO: support encryption
-        self.do_run_in_chroot('useradd {username}'.format(username=self.setup.username))
-        self.do_run_in_chroot("echo -ne \"{0}\\n{0}\\n\" | passwd {1}".format(self.setup.password1,self.setup.username))
-        self.do_run_in_chroot("echo -ne \"{0}\\n{0}\\n\" | passwd".format(self.setup.password1))
-        for g in ['audio', 'video', 'wheel']:
-            self.do_run_in_chroot('usermod -a -G {group} {username}'.format(group=g, username=self.setup.username))
+        users = accounts.Accounts("/target")
+        uid, gid = users.add_user(self.setup.username, self.setup.password1,
+                                  real_name=self.setup.real_name or '',
+                                  groups=['audio', 'video', 'wheel'])
+        users.set_password('root', self.setup.password1)
+        users.save()
         #Create Userspace area
-        self.do_run_in_chroot('mkdir -p /data/app/{username}'.format(username=self.setup.username))
-        self.do_run_in_chroot('chmod -R 641 /data/app/{username}'.format(username=self.setup.username))
-        self.do_run_in_chroot('chown -R {username} /data/app/{username}'.format(username=self.setup.username))
+        appdir = "/target/data/app/%s" % self.setup.username
+        os.makedirs(appdir, exist_ok=True)
+        os.chown(appdir, uid, -1)
+        os.chmod(appdir, 0o641)
 
         # Set autologin for user if they so elected
         if self.setup.autologin:
             # LightDM
-            self.do_run_in_chroot(
-                r"sed -i -r 's/^#?(autologin-user)\s*=.*/\1={user}/' /etc/lightdm/lightdm.conf".format(user=self.setup.username))
-
-        # /etc/fstab, mtab and crypttab
-        our_current += 1
-        self.update_progress(our_current, our_total, False, False,
-                             ("Writing filesystem mount information to /etc/fstab"))
-        self.write_fstab()
+            accounts.set_autologin("/target", self.setup.username)
+
+    @tracing.traced()
+    def do_copy(self, source, dest, exclude):
+        ''' Copy the live system with the built-in copy engine '''
+        engine = copier.CopyEngine(source, dest, exclude, manifest=self.manifest,
+                                   checkpointhook=lambda high_water: self.journal.mark('copy', high_water))
+        our_total = engine.scan()
+        print(" --> {} kopyalanıyor".format(
+            devices.to_human_readable(our_total)))
+        throughput = copier.Throughput(our_total)
+
+        def progress(our_current, path):
+            self.update_progress(min(our_current, our_total), our_total, False, False,
+                                 ("Kopyalanıyor /%s (%s)") % (path, throughput.update(our_current)))
+        engine.progresshook = progress
+        finished = engine.run(skip=self.journal.get('copy', 0))
+        if finished:
+            self.journal.mark('copy')
+            print("copy finished")
+        else:
+            print("copy finished with %d errors" % len(engine.errors))
+        if self.manifest is not None:
+            bad = self.manifest.verify(dest)
+            print("%d entries differ from the manifest" % len(bad))
+            for path in bad[:20]:
+                print("  /%s" % path)
+        if not finished:
+            # a resumed installation starts again from the last checkpoint
+            relpath, detail = engine.errors[0]
+            raise Exception(("%(count)d files could not be copied, the first one /%(path)s: %(detail)s") % {
+                'count': len(engine.errors), 'path': relpath, 'detail': detail})
+
+    @tracing.traced()
+    def do_copy_rsync(self, source, dest, exclude):
+        ''' Copy the live system with rsync, returns whether it copied everything '''
+        our_current = 0
+        our_total = copier.CopyEngine(
+            source, dest, exclude, manifest=self.manifest).scan()
+        print(" --> {} kopyalanıyor".format(
+            devices.to_human_readable(our_total)))
+        throughput = copier.Throughput(our_total)
+        # "<file length> <name>" for each transferred entry
+        argv = ["rsync", "--out-format=%l %n", "--archive", "--no-D", "--acls",
+                "--hard-links", "--xattrs"]
+        argv += ['--exclude=' + source + d for d in exclude]
+        argv += sorted(glob.glob(source + '*')) + [dest]
+        print("EXECUTING: '%s'" % commands.join(argv))
+        rsync = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        # read whatever rsync has written so far in one go, os.read blocks
+        # until there is output so there is no need to poll
+        fd = rsync.stdout.fileno()
+        pending = b''
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            if not lines:
+                continue
+            for line in lines:
+                length, _, name = line.partition(b' ')
+                if length.isdigit() and not name.endswith(b'/'):
+                    our_current += int(length)
+            our_current = min(our_current, our_total)
+            name = lines[-1].partition(b' ')[2].decode('utf-8', 'replace')
+            self.update_progress(our_current, our_total, False, False,
+                                 ("Kopyalanıyor /%s (%s)") % (name, throughput.update(our_current)))
+        rsync.wait()
+        print("rsync exited with returncode: " + str(rsync.poll()))
+        return rsync.returncode == 0
 
+    @tracing.traced()
     def mount_source(self):
         # Mount the installation media
         print(" --> Mounting partitions")
@@ -153,117 +302,160 @@ class InstallerEngine:
         print(" ------ Mounting %s on %s" % (self.media, "/source/"))
         self.do_mount(self.media, "/source/", "squashfs", options="loop")
 
-    def create_partitions(self):
-        # Create partitions on the selected disk (automated installation)
-        partition_prefix = ""
-        if self.setup.disk.startswith("/dev/nvme"):
-            partition_prefix = "p"
+    def assign_auto_partitions(self):
+        # Decide the partition layout of the selected disk (automated installation)
+        def partition(number):
+            return devices.get_partition_path(self.setup.disk, number)
         if self.setup.luks:
             if self.setup.gptonefi:
                 # EFI+LUKS/LVM
                 # sdx1=EFI, sdx2=BOOT, sdx3=ROOT
-                self.auto_efi_partition = self.setup.disk + partition_prefix + "1"
-                self.auto_boot_partition = self.setup.disk + partition_prefix + "2"
+                self.auto_efi_partition = partition(1)
+                self.auto_boot_partition = partition(2)
                 self.auto_swap_partition = None
-                self.auto_root_partition = self.setup.disk + partition_prefix + "3"
+                self.auto_root_partition = partition(3)
             else:
                 # BIOS+LUKS/LVM
                 # sdx1=BOOT, sdx2=ROOT
                 self.auto_efi_partition = None
-                self.auto_boot_partition = self.setup.disk + partition_prefix + "1"
+                self.auto_boot_partition = partition(1)
                 self.auto_swap_partition = None
-                self.auto_root_partition = self.setup.disk + partition_prefix + "2"
+                self.auto_root_partition = partition(2)
         elif self.setup.lvm:
             if self.setup.gptonefi:
                 # EFI+LVM
                 # sdx1=EFI, sdx2=ROOT
-                self.auto_efi_partition = self.setup.disk + partition_prefix + "1"
+                self.auto_efi_partition = partition(1)
                 self.auto_boot_partition = None
                 self.auto_swap_partition = None
-                self.auto_root_partition = self.setup.disk + partition_prefix + "2"
+                self.auto_root_partition = partition(2)
             else:
                 # BIOS+LVM:
                 # sdx1=ROOT
                 self.auto_efi_partition = None
                 self.auto_boot_partition = None
                 self.auto_swap_partition = None
-                self.auto_root_partition = self.setup.disk + partition_prefix + "1"
+                self.auto_root_partition = partition(1)
         else:
             if self.setup.gptonefi:
                 # EFI
                 # sdx1=EFI, sdx2=SWAP, sdx3=ROOT
-                self.auto_efi_partition = self.setup.disk + partition_prefix + "1"
+                self.auto_efi_partition = partition(1)
                 self.auto_boot_partition = None
-                self.auto_swap_partition = self.setup.disk + partition_prefix + "2"
-                self.auto_root_partition = self.setup.disk + partition_prefix + "3"
+                self.auto_swap_partition = partition(2)
+                self.auto_root_partition = partition(3)
             else:
                 # BIOS:
                 # sdx1=SWAP, sdx2=ROOT
                 self.auto_efi_partition = None
                 self.auto_boot_partition = None
-                self.auto_swap_partition = self.setup.disk + partition_prefix + "1"
-                self.auto_root_partition = self.setup.disk + partition_prefix + "2"
+                self.auto_swap_partition = partition(1)
+                self.auto_root_partition = partition(2)
 
         self.auto_root_physical_partition = self.auto_root_partition
 
+    @tracing.traced()
+    def create_partitions(self):
+        # Create partitions on the selected disk (automated installation)
         # Wipe HDD
         if self.setup.badblocks:
             self.update_progress(1, 4, False, False, (
                 "Filling %s with random data (please be patient, this can take hours...)") % self.setup.disk)
             print(" --> Filling %s with random data" % self.setup.disk)
-            os.system("badblocks -c 10240 -s -w -t random -v %s" %
-                      self.setup.disk)
+            commands.run(["badblocks", "-c", "10240", "-s", "-w", "-t", "random", "-v",
+                          self.setup.disk], capture=False)
 
         # Create partitions
         self.update_progress(1, 4, False, False,
                              ("%s üzerinde bölümler oluşturuluyor") % self.setup.disk)
         print(" --> Creating partitions on %s" % self.setup.disk)
         disk_device = parted.getDevice(self.setup.disk)
-        partitioning.full_disk_format(disk_device, create_boot=(
-            self.auto_boot_partition is not None), create_swap=(self.auto_swap_partition is not None))
-
+        devices.full_disk_format(disk_device, create_boot=(
+            self.auto_boot_partition is not None), create_swap=(self.auto_swap_partition is not None),
+            format_root=(self.setup.image is None), gptonefi=self.setup.gptonefi)
+        self.uuids.invalidate()
+
+        if self.setup.image is not None:
+            print(" --> Writing %s to %s" %
+                  (self.setup.image, self.auto_root_partition))
+
+            def progress(current, total):
+                self.update_progress(current, total, False, False, ("Sistem kalıbı %s üzerine yazılıyor") %
+                                     self.auto_root_partition)
+            devices.deploy_image(
+                self.setup.image, self.auto_root_partition, progresshook=progress)
+            self.image_deployed = True
+            # deploy_image gives the filesystem a new UUID
+            self.uuids.invalidate()
+
+    @tracing.traced()
+    def mount_auto_partitions(self):
         self.do_mount(self.auto_root_partition, "/target", "ext4", None)
         if (self.auto_boot_partition is not None):
-            os.system("mkdir -p /target/boot")
+            os.makedirs("/target/boot", exist_ok=True)
             self.do_mount(self.auto_boot_partition,
                           "/target/boot", "ext4", None)
         if (self.auto_efi_partition is not None):
-            os.system("mkdir -p /target/boot/efi")
+            os.makedirs("/target/boot/efi", exist_ok=True)
             self.do_mount(self.auto_efi_partition,
                           "/target/boot/efi", "vfat", None)
 
+    @tracing.traced()
     def format_partitions(self):
+        ''' Format the partitions, disks in parallel and the partitions of a disk one at a time '''
+        jobs = defaultdict(list)
         for partition in self.setup.partitions:
             if(partition.format_as is not None and partition.format_as != ""):
-                # report it. should grab the total count of filesystems to be formatted ..
-                self.update_progress(1, 4, True, False, ("Formatting %(partition)s as %(format)s ...") % {
-                                     'partition': partition.path, 'format': partition.format_as})
-
-                # Format it
-                if partition.format_as == "swap":
-                    cmd = "mkswap %s" % partition.path
-                else:
-                    if (partition.format_as in ['ext2', 'ext3', 'ext4']):
-                        cmd = "mkfs.%s -F %s" % (partition.format_as,
-                                                 partition.path)
-                    elif (partition.format_as == "jfs"):
-                        cmd = "mkfs.%s -q %s" % (partition.format_as,
-                                                 partition.path)
-                    elif (partition.format_as in ["btrfs", "xfs"]):
-                        cmd = "mkfs.%s -f %s" % (partition.format_as,
-                                                 partition.path)
-                    elif (partition.format_as == "vfat"):
-                        cmd = "mkfs.%s %s -F 32" % (partition.format_as,
-                                                    partition.path)
+                jobs[partition.partition.disk.device.path].append(partition)
+        our_total = sum(len(partitions) for partitions in jobs.values())
+        if not our_total:
+            return True
+        lock = threading.Lock()
+        finished = []
+        failed = []
+
+        def format_disk(partitions):
+            for partition in partitions:
+                result = commands.run(self.get_format_command(partition))
+                with lock:
+                    finished.append(partition)
+                    if not result.ok:
+                        print(result)
+                        failed.append(partition)
                     else:
-                        # works with bfs, minix, msdos, ntfs, vfat
-                        cmd = "mkfs.%s %s" % (
-                            partition.format_as, partition.path)
+                        partition.type = partition.format_as
+                    self.update_progress(len(finished), our_total, False, False, ("Formatting %(partition)s as %(format)s ...") % {
+                                         'partition': partition.path, 'format': partition.format_as})
+
+        self.update_progress(0, our_total, False, False, ("Formatting %d partitions ...") % our_total)
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            list(pool.map(format_disk, jobs.values()))
+        self.uuids.invalidate()
+        if failed:
+            self.error_message(message=("ERROR: Could not format %s") % ', '.join(
+                "%s (%s)" % (partition.path, partition.format_as) for partition in failed))
+            return False
+        return True
 
-                print("EXECUTING: '%s'" % cmd)
-                self.exec_cmd(cmd)
-                partition.type = partition.format_as
+    def get_format_command(self, partition):
+        if partition.format_as == "swap":
+            cmd = ["mkswap", partition.path]
+        else:
+            mkfs = "mkfs.%s" % partition.format_as
+            if (partition.format_as in ['ext2', 'ext3', 'ext4']):
+                cmd = [mkfs, "-F", partition.path]
+            elif (partition.format_as == "jfs"):
+                cmd = [mkfs, "-q", partition.path]
+            elif (partition.format_as in ["btrfs", "xfs"]):
+                cmd = [mkfs, "-f", partition.path]
+            elif (partition.format_as == "vfat"):
+                cmd = [mkfs, partition.path, "-F", "32"]
+            else:
+                # works with bfs, minix, msdos, ntfs, vfat
+                cmd = [mkfs, partition.path]
+        return cmd
 
+    @tracing.traced()
     def mount_partitions(self):
         # Mount the target partition
         for partition in self.setup.partitions:
@@ -293,10 +485,10 @@ class InstallerEngine:
                           (partition.path, "/target/"))
                     fs = partition.type
                     self.do_mount(partition.path, "/target", fs, None)
-                    os.system("btrfs subvolume create /target/@")
-                    os.system("btrfs subvolume list -p /target")
+                    commands.run(["btrfs", "subvolume", "create", "/target/@"])
+                    print(commands.output(["btrfs", "subvolume", "list", "-p", "/target"]))
                     print(" ------ Umount btrfs to remount subvolume /@")
-                    os.system("umount --force /target")
+                    self.do_unmount("/target")
                     self.do_mount(partition.path, "/target", fs, "subvol=@")
                     break
 
@@ -314,15 +506,15 @@ class InstallerEngine:
                     print(" ------ Mounting partition %s on %s" %
                           (partition.path, "/target/home"))
                     fs = partition.type
-                    os.system("mkdir -p /target/home")
+                    os.makedirs("/target/home", exist_ok=True)
                     self.do_mount(partition.path, "/target/home", fs, None)
                     # if reusing a btrfs with /@home already being there wont
                     # currently just keep it; data outside of /@home will still
                     # be there (just not reachable from the mounted /@home subvolume)
-                    os.system("btrfs subvolume create /target/home/@home")
+                    commands.run(["btrfs", "subvolume", "create", "/target/home/@home"])
                     #os.system("btrfs subvolume list -p /target/home")
                     print(" ------- Umount btrfs to remount subvolume /@home")
-                    os.system("umount --force /target/home")
+                    self.do_unmount("/target/home")
                     self.do_mount(partition.path, "/target/home",
                                   fs, "subvol=@home")
                     break
@@ -336,7 +528,7 @@ class InstallerEngine:
             if(partition.mount_as is not None and partition.mount_as != "" and partition.mount_as != "/" and partition.mount_as != "swap"):
                 print(" ------ Mounting %s on %s" %
                       (partition.path, "/target" + partition.mount_as))
-                os.system("mkdir -p /target" + partition.mount_as)
+                os.makedirs("/target" + partition.mount_as, exist_ok=True)
                 if partition.type == "fat16" or partition.type == "fat32":
                     fs = "vfat"
                 else:
@@ -345,26 +537,20 @@ class InstallerEngine:
                               partition.mount_as, fs, None)
 
     def get_blkid(self, path):
-        uuid = path  # If we can't find the UUID we use the path
-        blkid = subprocess.getoutput('blkid').split('\n')
-        for blkid_line in blkid:
-            blkid_elements = blkid_line.split(':')
-            if blkid_elements[0] == path:
-                blkid_mini_elements = blkid_line.split()
-                for blkid_mini_element in blkid_mini_elements:
-                    if "UUID=" in blkid_mini_element:
-                        uuid = blkid_mini_element.replace('"', '').strip()
-                        break
-                break
-        return uuid
+        uuid = self.uuids.get(path)
+        if uuid is None:
+            # If we can't find the UUID we use the path
+            return path
+        return "UUID=%s" % uuid
 
+    @tracing.traced()
     def write_fstab(self):
         # write the /etc/fstab
         print(" --> Writing fstab")
         # make sure fstab has default /proc and /sys entries
         if(not os.path.exists("/target/etc/fstab")):
-            os.system(
-                "echo \"#### Static Filesystem Table File\" > /target/etc/fstab")
+            with open("/target/etc/fstab", "w") as fstab:
+                fstab.write("#### Static Filesystem Table File\n")
         fstab = open("/target/etc/fstab", "a")
         fstab.write("proc\t/proc\tproc\tdefaults\t0\t0\n")
         if(not self.setup.skip_mount):
@@ -426,43 +612,54 @@ class InstallerEngine:
         fstab.close()
 
 
+    @tracing.traced()
     def finish_installation(self):
-        # Steps:
-        our_total = 11
-        our_current = 4
-
+        graph = scheduler.TaskGraph(progresshook=self.report_step)
+        graph.add('locale', self.set_locale, message=("Setting locale"))
+        graph.add('hostname', self.set_hostname, message=("Setting hostname"))
+        graph.add('timezone', self.set_timezone, message=("Setting timezone"))
+        graph.add('keyboard', self.set_keyboard, message=("Setting keyboard options"))
+        if self.setup.grub_device is not None:
+            graph.add('grub-install', self.journaled('grub-install', self.install_grub),
+                      message=("Installing bootloader"))
+            graph.add('grub', self.configure_grub, requires=['grub-install'],
+                      message=("Configuring bootloader"))
+        finished = False
+        try:
+            graph.run()
+            finished = True
+        finally:
+            self.unmount_target(finished)
+            # the interface waits for this one, also when a step failed
+            self.update_progress(0, 0, False, True, ("Installation finished") if finished
+                                 else ("Installation failed"))
+        commands.report()
+        print(" --> All done")
 
-        # set the locale
+    def set_locale(self):
         print(" --> Yerel ayarlanıyor")
-        our_current += 1
-        self.update_progress(our_current, our_total, False,
-                             False, ("Setting locale"))
-        os.system("echo \"LC_COLLATE=C\" > /target/etc/env.d/02locale")
-        os.system("echo \"LC_ALL=%s.UTF-8\" >> /target/etc/env.d/02locale" %
-                  self.setup.language)
-        self.update_progress(our_current, our_total, False,
-                             False, ("Updating environment"))
-        os.system("echo \"LANG=%s.UTF-8\" >> /target/etc/env.d/02locale" %
-                  self.setup.language)
+        with open("/target/etc/env.d/02locale", "w") as localefh:
+            localefh.write("LC_COLLATE=C\n")
+            localefh.write("LC_ALL=%s.UTF-8\n" % self.setup.language)
+            localefh.write("LANG=%s.UTF-8\n" % self.setup.language)
         self.do_run_in_chroot("cat /etc/env.d/* | grep -v \"^#\" > /etc/environment")
 
-
-        # set the hostname
+    def set_hostname(self):
         print(" --> Bilgisayar adı ayarlanıyor")
-        os.system("echo \"%s\" > /target/etc/hostname" % self.setup.hostname)
+        with open("/target/etc/hostname", "w") as hostnamefh:
+            hostnamefh.write("%s\n" % self.setup.hostname)
 
-        # set the timezone
+    def set_timezone(self):
         print(" --> Zaman dilimi ayarlanıyor")
-        os.system("echo \"%s\" > /target/etc/timezone" % self.setup.timezone)
-        os.system("rm -f /target/etc/localtime")
-        os.system("ln -s /usr/share/zoneinfo/%s /target/etc/localtime" %
-                  self.setup.timezone)
-
-        # set the keyboard options..
+        with open("/target/etc/timezone", "w") as timezonefh:
+            timezonefh.write("%s\n" % self.setup.timezone)
+        if os.path.lexists("/target/etc/localtime"):
+            os.remove("/target/etc/localtime")
+        os.symlink("/usr/share/zoneinfo/%s" % self.setup.timezone,
+                   "/target/etc/localtime")
+
+    def set_keyboard(self):
         print(" --> Klavye ayarlanıyor")
-        our_current += 1
-        self.update_progress(our_current, our_total, False,
-                             False, ("Setting keyboard options"))
         #Keyboard settings openrc
         newconsolefh = open("/target/etc/conf.d/keymaps", "w")
         if not self.setup.keyboard_layout:
@@ -472,9 +669,6 @@ class InstallerEngine:
         newconsolefh.write("keymap=\"{}{}\"\n".format(self.setup.keyboard_layout,self.setup.keyboard_variant))
         newconsolefh.close()
         #Keyboard settings X11
-        self.update_progress(our_current, our_total, False,
-                             False, ("Settings X11 keyboard options"))
-        
         newconsolefh = open("/target/etc/X11/xorg.conf.d/10-keyboard.conf", "w")
         newconsolefh.write('Section "InputClass"\n')
         newconsolefh.write('Identifier "system-keyboard"\n')
@@ -486,115 +680,121 @@ class InstallerEngine:
         newconsolefh.write('EndSection\n')
         newconsolefh.close()
 
-
-         
+    @tracing.traced()
+    def install_grub(self):
         # write MBR (grub)
-        print(" --> Grub Ayarlanıyor")
-        our_current += 1
-        if(self.setup.grub_device is not None):
-            self.update_progress(our_current, our_total,
-                                 False, False, ("Installing bootloader"))
-            print(" --> Running grub-install")
-            self.do_run_in_chroot("grub-install --force %s" %
-                                  self.setup.grub_device)
-            self.update_progress(our_current, our_total, False,
-                             False, ("Configuring bootloader"))
-        
-            # fix not add windows grub entry
-            self.do_run_in_chroot("update-grub")
-            self.do_configure_grub(our_total, our_current)
-            grub_retries = 0
-            while (not self.do_check_grub(our_total, our_current)):
-                self.do_configure_grub(our_total, our_current)
-                grub_retries = grub_retries + 1
-                if grub_retries >= 5:
-                    self.error_message(message=(
-                        "WARNING: The grub bootloader was not configured properly! You need to configure it manually."))
-                    break
+        print(" --> Running grub-install")
+        self.do_run_in_chroot("grub-install --force %s" %
+                              self.setup.grub_device)
 
+    @tracing.traced()
+    def configure_grub(self):
+        print(" --> Grub Ayarlanıyor")
+        if self.journal.done('grub'):
+            return
+        # grub-mkconfig also adds the entries of other systems (windows), update-grub
+        # would only run it one more time
+        for attempt in range(GRUB_ATTEMPTS):
+            if self.do_configure_grub() and self.do_check_grub():
+                self.journal.mark('grub')
+                return
+            print(" --> Grub configuration failed (attempt %d of %d)" %
+                  (attempt + 1, GRUB_ATTEMPTS))
+        self.error_message(message=(
+            "WARNING: The grub bootloader was not configured properly! You need to configure it manually."))
 
+    @tracing.traced()
+    def unmount_target(self, finished=True):
         # now unmount it
         print(" --> Bölümler ayrılıyor")
-        self.update_progress(our_current, our_total, False,
-                             False, ("Unmounting Partitions"))
+        self.update_progress(0, 0, True, False, ("Unmounting Partitions"))
         
-        os.system("umount --force /target/dev/shm")
-        os.system("umount --force /target/dev/pts")
-        if self.setup.gptonefi:
-            os.system("umount --force /target/boot/efi")
-            os.system("umount --force /target/media/cdrom")
-        os.system("umount --force /target/boot")
-        os.system("umount --force /target/dev/")
-        os.system("umount --force /target/sys/")
-        os.system("umount --force /target/proc/")
-        os.system("umount --force /target/run/")
-        os.system("rm -f /target/etc/resolv.conf")
-        os.system("mv /target/etc/resolv.conf.bk /target/etc/resolv.conf")
-        if(not self.setup.skip_mount):
-            for partition in self.setup.partitions:
-                if(partition.mount_as is not None and partition.mount_as != "" and partition.mount_as != "/" and partition.mount_as != "swap"):
-                    self.do_unmount("/target" + partition.mount_as)
-            self.do_unmount("/target")
-        self.do_unmount("/source")
-
-        self.update_progress(0, 0, False, True, ("Installation finished"))
-        print(" --> All done")
+        # the chroot shells keep /target busy
+        self.chroot.close()
+
+        # nothing left to resume unless the bootloader failed
+        if finished and (self.setup.grub_device is None or self.journal.done('grub')):
+            self.journal.discard()
+
+        if os.path.lexists("/target/etc/resolv.conf.bk"):
+            os.replace("/target/etc/resolv.conf.bk", "/target/etc/resolv.conf")
+        # chroot binds, partitions and /source, as far as they are still mounted;
+        # a /target mounted by the user (skip_mount) is left alone
+        for error in self.mounts.teardown():
+            print(error)
+
+    def unmount_chroot(self):
+        ''' Unmount what an earlier attempt bound into /target, returns the errors '''
+        errors = []
+        for path in reversed(CHROOT_MOUNTS):
+            try:
+                mounts.umount_tree("/target" + path)
+            except Exception as detail:
+                errors.append(str(detail))
+        return errors
 
     def do_run_in_chroot(self, command):
+        ''' Run a shell command inside /target, returns (status, output) '''
         command = command.replace('"', "'").strip()
-        print("chroot /target/ /bin/sh -c \"%s\"" % command)
-        os.system("chroot /target/ /bin/sh -c \"%s\"" % command)
-
-    def do_configure_grub(self, our_total, our_current):
-        self.update_progress(our_current, our_total, True,
+        print("chroot /target/ %s" % command)
+        status, output = self.chroot.run(command)
+        if status != 0:
+            print("chroot command failed with status %d:\n%s" % (status, output))
+        return status, output
+
+    def do_configure_grub(self):
+        ''' Generate grub.cfg, returns True if grub-mkconfig succeeded '''
+        self.update_progress(0, 0, True,
                              False, ("Configuring bootloader"))
         print(" --> Running grub-mkconfig")
-        self.do_run_in_chroot("grub-mkconfig -o /boot/grub/grub.cfg")
-        grub_output = subprocess.getoutput(
-            "chroot /target/ /bin/sh -c \"grub-mkconfig -o /boot/grub/grub.cfg\"")
-        grubfh = open("/var/log/live-installer-grub-output.log", "w")
-        grubfh.writelines(grub_output)
-        grubfh.close()
-
-    def do_check_grub(self, our_total, our_current):
-        self.update_progress(our_current, our_total, True,
+        status, output = self.do_run_in_chroot("grub-mkconfig -o /boot/grub/grub.cfg")
+        with open(GRUB_LOG, "w") as grubfh:
+            grubfh.write(output)
+            grubfh.write("\n--> exit status %d\n" % status)
+        return status == 0
+
+    def do_check_grub(self):
+        ''' Make sure the generated grub.cfg is there and parses '''
+        self.update_progress(0, 0, True,
                              False, ("Checking bootloader"))
         print(" --> Checking Grub configuration")
-        time.sleep(5)
-        if os.path.exists("/target/boot/grub/grub.cfg"):
-            return True
-        else:
+        if not os.path.exists("/target/boot/grub/grub.cfg"):
             print("!No /target/boot/grub/grub.cfg file found!")
             return False
+        if os.path.getsize("/target/boot/grub/grub.cfg") == 0:
+            print("!/target/boot/grub/grub.cfg is empty!")
+            return False
+        status, output = self.do_run_in_chroot(
+            "! command -v grub-script-check >/dev/null || grub-script-check /boot/grub/grub.cfg")
+        return status == 0
 
     def do_mount(self, device, dest, type, options=None):
-        ''' Mount a filesystem '''
-        p = None
-        if(options is not None):
-            cmd = "mount -o %s -t %s %s %s" % (options, type, device, dest)
-        else:
-            cmd = "mount -t %s %s %s" % (type, device, dest)
-        print("EXECUTING: '%s'" % cmd)
-        self.exec_cmd(cmd)
+        ''' Mount a filesystem, raises OSError if it can't be mounted '''
+        print("Mounting %s on %s (%s, %s)" % (device, dest, type, options or "defaults"))
+        self.mounts.mount(device, dest, type, options)
 
     def do_unmount(self, mountpoint):
-        ''' Unmount a filesystem '''
-        cmd = "umount %s" % mountpoint
-        print("EXECUTING: '%s'" % cmd)
-        self.exec_cmd(cmd)
+        ''' Unmount a filesystem, raises OSError if it can't be unmounted '''
+        print("Unmounting %s" % mountpoint)
+        self.mounts.umount(mountpoint)
 
-    # Execute schell command and return output in a list
-    def exec_cmd(self, cmd):
-        return os.system(cmd)
+    # Execute a command (argv list), returns its commands.Result
+    def exec_cmd(self, argv, **kwargs):
+        return commands.run(argv, **kwargs)
 
 
+    @tracing.traced()
     def run_preinstall(self):
-        os.system("bash /usr/lib/live-installer/scripts/preinstall.sh")
+        result = self.exec_cmd(["bash", "/usr/lib/live-installer/scripts/preinstall.sh"],
+                               capture=False)
+        if not result.ok:
+            print(result)
         
+    @tracing.traced()
     def run_postinstall(self):
-        os.system("cp /usr/lib/live-installer/scripts/postinstall.sh /target/tmp/script.sh")
-        os.system("chroot /target /tmp/script.sh")
-        os.system(" rm -f /target/tmp/script")
+        shutil.copy("/usr/lib/live-installer/scripts/postinstall.sh", "/target/tmp/script.sh")
+        self.do_run_in_chroot("/tmp/script.sh")
+        os.remove("/target/tmp/script.sh")
         
         
 # Represents the choices made by the user
@@ -626,6 +826,10 @@ class Setup(object):
     badblocks = False
     target_disk = None
     gptonefi = False
+    # Copy the live system with rsync instead of the built-in copy engine
+    copy_with_rsync = False
+    # Filesystem image written to the root partition in automated mode instead of copying files
+    image = None
     # Optionally skip all mouting/partitioning for advanced users with custom setups (raid/dmcrypt/etc)
     # Make sure the user knows that they need to:
     #  * Mount their target directory structure at /target
@@ -640,6 +844,15 @@ class Setup(object):
     keyboard_layout_description = None
     keyboard_variant_description = None
 
+    def fingerprint(self):
+        ''' Identifies the choices an installation journal was written for '''
+        choices = [self.automated, self.skip_mount, self.disk, self.image,
+                   self.username, self.hostname, self.grub_device]
+        for partition in self.partitions:
+            choices.append(
+                (partition.path, partition.format_as, partition.mount_as))
+        return hashlib.sha1(repr(choices).encode('utf-8')).hexdigest()
+
     def print_setup(self):
         if True:
             print(
@@ -658,6 +871,7 @@ class Setup(object):
             print("automated: %s" % self.automated)
             if self.automated:
                 print("disk: %s (%s)" % (self.disk, self.diskname))
+                print("image: %s" % self.image)
                 print("luks: %s" % self.luks)
                 print("badblocks: %s" % self.badblocks)
                 print("lvm: %s" % self.lvm)
@@ -0,0 +1,61 @@
+import json
+import os
+import threading
+
+
+class Journal(object):
+    ''' Persistent record of the installation steps that completed '''
+    # Lives on the target so a retry can pick up where the last attempt stopped.
+    # A journal written for different choices (other disk, partitions, user...)
+    # is ignored.
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.steps = {}
+        # steps may finish on several threads at once
+        self.lock = threading.Lock()
+
+    def load(self):
+        ''' Read the journal of an earlier attempt, returns True if it applies to this setup '''
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get('fingerprint') != self.fingerprint:
+            print("Ignoring %s, it was written for another setup" % self.path)
+            return False
+        self.steps = data.get('steps', {})
+        print("Resuming installation, completed steps: %s" %
+              ', '.join(sorted(self.steps)))
+        return True
+
+    def done(self, step):
+        return self.steps.get(step) is True
+
+    def get(self, step, default=None):
+        return self.steps.get(step, default)
+
+    def mark(self, step, value=True):
+        ''' Record a step (or its progress with a non-True value) and write the journal '''
+        with self.lock:
+            self.steps[step] = value
+            self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'fingerprint': self.fingerprint,
+                       'steps': self.steps}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def discard(self):
+        self.steps = {}
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+# Build and read the manifest of the live filesystem.
+#
+# The manifest lists every entry the installer copies, in CopyEngine.walk()
+# order, so the installer gets its progress total and hard-link groups without
+# walking /source. Build it against the unpacked root filesystem when making
+# the live medium:
+#
+#     python3 manifest.py /path/to/rootfs filesystem.manifest
+#
+# File layout (little-endian): a header, then one array per field so the
+# whole file can be mapped and read in place.
+#
+#     header   magic, version, count, blob size, total bytes
+#     sizes    uint64[count]
+#     modes    uint32[count]
+#     links    int32[count]    index of the first entry of the same inode, or -1
+#     offsets  uint32[count+1] start of each path in the blob
+#     flags    uint8[count]    FLAG_XATTRS
+#     blob     the relative paths, back to back
+
+import mmap
+import os
+import stat
+import struct
+import sys
+from array import array
+
+import copier
+
+MAGIC = b'LIMF'
+VERSION = 1
+HEADER = struct.Struct('<4sIIQQ')
+FLAG_XATTRS = 1
+
+
+def build_manifest(source, output, exclude=copier.EXCLUDE_DIRS):
+    ''' Write the manifest of the tree under source to output '''
+    engine = copier.CopyEngine(source, '/', exclude)
+    sizes, modes, links = array('Q'), array('I'), array('i')
+    offsets, flags, blob = array('I', [0]), array('B'), bytearray()
+    inodes = {}
+    total = 0
+    for relpath, st in engine.walk():
+        link = -1
+        if stat.S_ISREG(st.st_mode):
+            key = (st.st_dev, st.st_ino)
+            if st.st_nlink > 1 and key in inodes:
+                link = inodes[key]
+            else:
+                if st.st_nlink > 1:
+                    inodes[key] = len(sizes)
+                total += st.st_size
+        try:
+            has_xattrs = bool(os.listxattr(os.path.join(engine.source, relpath),
+                                           follow_symlinks=False))
+        except OSError:
+            has_xattrs = False
+        sizes.append(st.st_size)
+        modes.append(st.st_mode)
+        links.append(link)
+        flags.append(FLAG_XATTRS if has_xattrs else 0)
+        blob += os.fsencode(relpath)
+        offsets.append(len(blob))
+    if engine.errors:
+        raise Exception("Could not read %d entries of %s" %
+                        (len(engine.errors), source))
+    if sys.byteorder != 'little':
+        for values in (sizes, modes, links, offsets):
+            values.byteswap()
+    tmp = output + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(sizes), len(blob), total))
+        for values in (sizes, modes, links, offsets, flags):
+            values.tofile(f)
+        f.write(blob)
+    os.replace(tmp, output)
+    return len(sizes), total
+
+
+class Manifest(object):
+    ''' Read-only, memory-mapped view of a manifest file '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, blob_size, self.total_size = HEADER.unpack_from(
+            self.map)
+        if magic != MAGIC or version != VERSION:
+            raise Exception("%s is not a version %d manifest" % (path, VERSION))
+        if sys.byteorder != 'little':
+            raise Exception("Manifests can only be read on little-endian machines")
+        view = memoryview(self.map)
+        offset = HEADER.size
+
+        def field(code, length):
+            nonlocal offset
+            size = struct.calcsize(code) * length
+            values = view[offset:offset + size].cast(code)
+            offset += size
+            return values
+        self.sizes = field('Q', count)
+        self.modes = field('I', count)
+        self.links = field('i', count)
+        self.offsets = field('I', count + 1)
+        self.flags = field('B', count)
+        self.blob = view[offset:offset + blob_size]
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def path(self, index):
+        return os.fsdecode(bytes(self.blob[self.offsets[index]:self.offsets[index + 1]]))
+
+    def has_xattrs(self, index):
+        return bool(self.flags[index] & FLAG_XATTRS)
+
+    def verify(self, dest):
+        ''' Return the paths whose copy under dest is missing or differs in type or size '''
+        bad = []
+        for index in range(len(self)):
+            relpath = self.path(index)
+            mode = self.modes[index]
+            if not (stat.S_ISDIR(mode) or stat.S_ISREG(mode) or stat.S_ISLNK(mode)):
+                continue  # not copied
+            try:
+                st = os.lstat(os.path.join(dest, relpath))
+            except OSError:
+                bad.append(relpath)
+                continue
+            if stat.S_IFMT(st.st_mode) != stat.S_IFMT(mode) or (
+                    stat.S_ISREG(mode) and st.st_size != self.sizes[index]):
+                bad.append(relpath)
+        return bad
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: %s <root filesystem> <manifest>" % sys.argv[0])
+        sys.exit(1)
+    count, total = build_manifest(sys.argv[1], sys.argv[2])
+    print("%d entries, %d bytes" % (count, total))
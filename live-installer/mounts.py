@@ -0,0 +1,257 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import stat
+import threading
+
+import commands
+import dryrun
+
+libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+libc.mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p,
+                       ctypes.c_ulong, ctypes.c_char_p]
+libc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+libc.unshare.argtypes = [ctypes.c_int]
+
+# linux/mount.h
+MS_RDONLY = 1
+MS_NOSUID = 2
+MS_NODEV = 4
+MS_NOEXEC = 8
+MS_REMOUNT = 32
+MS_BIND = 4096
+MS_REC = 16384
+MS_PRIVATE = 1 << 18
+MS_SLAVE = 1 << 19
+MNT_FORCE = 1
+MNT_DETACH = 2
+# linux/sched.h
+CLONE_NEWNS = 0x00020000
+
+# mount options that are flags, everything else is passed to the filesystem
+FLAGS = {
+    'ro': MS_RDONLY,
+    'nosuid': MS_NOSUID,
+    'nodev': MS_NODEV,
+    'noexec': MS_NOEXEC,
+    'remount': MS_REMOUNT,
+    'bind': MS_BIND,
+    'rbind': MS_BIND | MS_REC,
+}
+# the flags and options mount(8) accepts that mean "the default"
+DEFAULTS = ['rw', 'defaults', 'suid', 'dev', 'exec', 'auto', 'noauto']
+
+MOUNTINFO = '/proc/self/mountinfo'
+
+
+def _encode(value):
+    return None if value is None else os.fsencode(value)
+
+
+def mount(source, target, fstype=None, flags=0, data=None):
+    ''' mount(2), raises OSError '''
+    if dryrun.plan is not None:
+        return dryrun.plan.mount(source, target, fstype, flags, data)
+    if libc.mount(_encode(source), _encode(target), _encode(fstype), flags, _encode(data)) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, "Could not mount %s on %s: %s" %
+                      (source, target, os.strerror(error)))
+
+
+def umount(target, flags=0):
+    ''' umount2(2), raises OSError '''
+    if dryrun.plan is not None:
+        return dryrun.plan.umount(target, flags)
+    if libc.umount2(_encode(target), flags) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, "Could not unmount %s: %s" %
+                      (target, os.strerror(error)))
+
+
+def private_namespace():
+    ''' Give this process its own mount table; what it mounts from now on is not seen outside '''
+    if libc.unshare(CLONE_NEWNS) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, "Could not create a mount namespace: %s" % os.strerror(error))
+    # mounts would still propagate to the original table through shared mount points
+    mount(None, '/', None, MS_REC | MS_PRIVATE)
+
+
+def parse_options(options):
+    ''' Split a mount -o string into (flags, data) '''
+    flags = 0
+    data = []
+    for option in (options or '').split(','):
+        option = option.strip()
+        if not option or option in DEFAULTS:
+            continue
+        if option in FLAGS:
+            flags |= FLAGS[option]
+        else:
+            data.append(option)
+    return flags, ','.join(data) or None
+
+
+def mount_device(device, target, fstype, options=None):
+    ''' Mount like mount -t fstype -o options device target '''
+    flags, data = parse_options(options)
+    if data is not None and 'loop' in data.split(','):
+        if os.path.exists(device) and stat.S_ISBLK(os.stat(device).st_mode):
+            # already a block device (the live medium is /dev/loop0)
+            data = ','.join(o for o in data.split(',') if o != 'loop') or None
+        else:
+            raise Exception("Can not mount %s, loop devices are not set up here" % device)
+    try:
+        mount(device, target, fstype, flags, data)
+    except OSError as detail:
+        if detail.errno != errno.ENODEV or not fstype:
+            raise
+        # no driver in the kernel, mount(8) knows the helpers (mount.ntfs is ntfs-3g)
+        mount_helper(device, target, fstype, options)
+
+
+def mount_helper(device, target, fstype, options=None):
+    ''' Mount with mount(8), raises OSError '''
+    argv = ['mount', '-t', fstype] + (['-o', options] if options else []) + [device, target]
+    result = commands.run(argv)
+    if not result.ok:
+        raise OSError(errno.ENODEV, "Could not mount %s on %s: %s" % (
+            device, target, (result.error or result.output).strip() or result))
+
+
+def bind_tree(source, target):
+    ''' Bind source and everything mounted below it on target '''
+    mount(source, target, None, MS_BIND | MS_REC)
+    # unmounting the copy must not unmount the original
+    mount(None, target, None, MS_SLAVE | MS_REC)
+
+
+def unescape(path):
+    ''' mountinfo writes space, tab, newline and backslash as octal escapes '''
+    for escape, char in (('\\040', ' '), ('\\011', '\t'), ('\\012', '\n'), ('\\134', '\\')):
+        path = path.replace(escape, char)
+    return path
+
+
+def mount_table():
+    ''' (mount id, parent id, mount point) of every mount of this process, in mountinfo order '''
+    if dryrun.plan is not None:
+        return dryrun.plan.mount_table()
+    table = []
+    with open(MOUNTINFO) as f:
+        for line in f:
+            fields = line.split()
+            table.append((int(fields[0]), int(fields[1]), unescape(fields[4])))
+    return table
+
+
+def mount_source(path):
+    ''' The device (or other source) mounted on path, None if nothing is '''
+    path = os.path.realpath(path)
+    source = None
+    with open(MOUNTINFO) as f:
+        for line in f:
+            fields = line.split()
+            # the optional fields end with '-', then come the type and the source
+            if unescape(fields[4]) == path:
+                source = unescape(fields[fields.index('-') + 2])
+    return source
+
+
+def is_under(mountpoint, path):
+    path = os.path.realpath(path)
+    return mountpoint == path or mountpoint.startswith(path.rstrip('/') + '/')
+
+
+def is_mounted(path):
+    return os.path.realpath(path) in set(mountpoint for _, _, mountpoint in mount_table())
+
+
+def mountpoints_under(path):
+    return [mountpoint for _, _, mountpoint in mount_table() if is_under(mountpoint, path)]
+
+
+def unmount_order(entries):
+    ''' Sort mount table entries so every mount comes before the one it sits on '''
+    order = []
+    remaining = list(entries)
+    while remaining:
+        parents = set(parent for _, parent, _ in remaining)
+        # later mounts first among the ones nothing else depends on
+        order.extend(reversed([entry for entry in remaining if entry[0] not in parents]))
+        remaining = [entry for entry in remaining if entry[0] in parents]
+    return order
+
+
+def umount_entries(entries):
+    ''' Unmount the given mount table entries, busy ones are detached lazily; returns the errors '''
+    errors = []
+    for _, _, mountpoint in unmount_order(entries):
+        try:
+            umount(mountpoint)
+        except OSError as detail:
+            if detail.errno == errno.EINVAL:
+                # went away with its parent (propagation) or already unmounted
+                continue
+            if detail.errno != errno.EBUSY:
+                errors.append(str(detail))
+                continue
+            # something still has files open there, don't hang on it
+            try:
+                umount(mountpoint, MNT_DETACH)
+                print("%s is busy, detached it" % mountpoint)
+            except OSError as detail:
+                errors.append(str(detail))
+    return errors
+
+
+def umount_tree(path):
+    ''' Unmount path and everything below it, raises an exception listing what could not be unmounted '''
+    errors = umount_entries([entry for entry in mount_table() if is_under(entry[2], path)])
+    if errors:
+        raise Exception('; '.join(errors))
+
+
+class MountRegistry(object):
+    ''' Remembers what the installer mounted so all of it can be unmounted at the end '''
+    # The mount table is the reference: teardown unmounts whatever is still
+    # mounted at or below the registered mount points (submounts of recursive
+    # binds included), children before parents.
+
+    def __init__(self):
+        self.mountpoints = []
+        self.lock = threading.Lock()
+
+    def register(self, target):
+        with self.lock:
+            target = os.path.realpath(target)
+            if target not in self.mountpoints:
+                self.mountpoints.append(target)
+
+    def mount(self, device, target, fstype, options=None):
+        mount_device(device, target, fstype, options)
+        self.register(target)
+
+    def bind_tree(self, source, target):
+        bind_tree(source, target)
+        self.register(target)
+
+    def umount(self, target):
+        umount(target)
+        with self.lock:
+            target = os.path.realpath(target)
+            if target in self.mountpoints and not is_mounted(target):
+                self.mountpoints.remove(target)
+
+    def teardown(self):
+        ''' Unmount everything that was registered, returns the errors '''
+        with self.lock:
+            mountpoints, self.mountpoints = self.mountpoints, []
+        table = mount_table()
+        mounted = set(mountpoint for _, _, mountpoint in table)
+        for mountpoint in mountpoints:
+            if mountpoint not in mounted:
+                print("%s is not mounted anymore" % mountpoint)
+        return umount_entries([entry for entry in table
+                               if any(is_under(entry[2], mountpoint) for mountpoint in mountpoints)])
@@ -2,14 +2,22 @@
 #
 
 
-import time
 import parted
-from gi.repository import Gtk, Gdk, GObject
+from gi.repository import Gtk, Gdk, GObject, GLib
 import os
-import re
 import sys
-import subprocess
+import glob
+import tempfile
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import commands
+import mounts
+import tracing
+# the parts that work without a display live in devices, they are used from here as before
+from devices import (EFI_MOUNT_POINT, ROOT_IMAGE, SWAP_MOUNT_POINT, is_efi_supported,
+                     path_exists, get_disks, to_human_readable)
+import devices
 import gi
 gi.require_version('Gtk', '3.0')
 
@@ -21,14 +29,6 @@ def idle(func):
     return wrapper
 
 
-def shell_exec(command):
-    return subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
-
-
-def getoutput(command):
-    return shell_exec(command).stdout.read().strip()
-
-
 (IDX_PART_PATH,
  IDX_PART_TYPE,
  IDX_PART_DESCRIPTION,
@@ -40,65 +40,27 @@ def getoutput(command):
  IDX_PART_DISK) = list(range(9))
 
 
-def is_efi_supported():
-    # Are we running under with efi ?
-    os.system("modprobe efivars >/dev/null 2>&1")
-    return os.path.exists("/proc/efi") or os.path.exists("/sys/firmware/efi")
-
-
-def path_exists(*args):
-    return os.path.exists(os.path.join(*args))
-
-
+# every partition is mounted on a directory of its own below this while it is probed
 TMP_MOUNTPOINT = '/tmp/live-installer/tmpmount'
+# partitions probed at the same time
+PROBE_WORKERS = 8
+
+# (path, start, length, filesystem type, UUID, label, generation) -> (size, free, description)
+# of the partitions probed so far; a partition that did not change is not probed
+# again when the partition page is built another time
+probe_cache = {}
+probe_cache_lock = threading.Lock()
+
+# milliseconds to wait after a block device event for the rest of its burst
+# (a partition table write changes the disk and every partition on it)
+REFRESH_DELAY = 300
+# devices.BlockEvents of the session, {disk path: action} not refreshed yet, and
+# of the events that came while another page was shown
+block_events = None
+pending_events = {}
+dirty_disks = {}
 RESOURCE_DIR = './resources/'
 
-EFI_MOUNT_POINT = '/boot/efi'
-SWAP_MOUNT_POINT = 'swap'
-
-
-def get_disks():
-    disks = []
-    exclude_devices = ['/dev/sr0', '/dev/sr1',
-                       '/dev/cdrom', '/dev/dvd', '/dev/fd0', '/dev/nullb0']
-    live_device = subprocess.getoutput(
-        "findmnt -n -o source /run/live/medium").split('\n')[0]
-    # remove partition numbers if any
-    live_device = re.sub('[0-9]+$', '', live_device)
-    if live_device is not None and live_device.startswith('/dev/'):
-        exclude_devices.append(live_device)
-        print("Excluding %s (detected as the live device)" % live_device)
-    lsblk = shell_exec(
-        'LC_ALL=en_US.UTF-8 lsblk -rindo TYPE,NAME,RM,SIZE,MODEL | sort -k3,2')
-    for line in lsblk.stdout:
-        try:
-            elements = str(line).strip().split(" ")
-            if len(elements) < 4:
-                print("Can't parse blkid output: %s" % elements)
-                continue
-            elif len(elements) < 5:
-                print("Can't find model in blkid output: %s" % elements)
-                type, device, removable, size, model = elements[
-                    0], elements[1], elements[2], elements[3], elements[1]
-            else:
-                type, device, removable, size, model = elements
-            device = "/dev/" + device
-            print(str(type))
-            if str(type) == "b'disk" and device not in exclude_devices:
-                # convert size to manufacturer's size for show, e.g. in GB, not GiB!
-                unit_index = 'BKMGTPEZY'.index(size.upper()[-1])
-                l10n_unit = [('B'), ('kB'), ('MB'), ('GB'), (
-                    'TB'), 'PB', 'EB', 'ZB', 'YB'][unit_index]
-                size = "%s %s" % (
-                    str(int(float(size[:-1]) * (1024/1000)**unit_index)), l10n_unit)
-                model = model.replace("\\x20", " ")
-                description = '{} ({})'.format(model.strip(), size)
-                if int(removable):
-                    description = ('Removable:') + ' ' + description
-                disks.append((device, description))
-        except Exception as detail:
-            print("Could not parse blkid output: %s (%s)" % (line, detail))
-    return disks
 
 
 def build_partitions(_installer):
@@ -108,6 +70,7 @@ def build_partitions(_installer):
         Gdk.Cursor.new(Gdk.CursorType.WATCH))  # "busy" cursor
     installer.window.set_sensitive(False)
     print("Starting PartitionSetup()")
+    dirty_disks.clear()
     partition_setup = PartitionSetup()
     print("Finished PartitionSetup()")
     if partition_setup.disks:
@@ -117,6 +80,59 @@ def build_partitions(_installer):
     installer.builder.get_object("treeview_disks").expand_all()
     installer.window.get_window().set_cursor(None)
     installer.window.set_sensitive(True)
+    watch_block_devices()
+
+
+def watch_block_devices():
+    ''' Follow disks being plugged, unplugged and repartitioned while the partition page is shown '''
+    global block_events
+    if block_events is not None:
+        return
+    try:
+        block_events = devices.BlockEvents()
+    except OSError as detail:
+        print("Not watching block devices: %s" % detail)
+        return
+    GLib.io_add_watch(block_events.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, on_block_events)
+
+
+def merge_events(events, changed):
+    ''' Add {disk path: action} to events; an add or remove says more than a change '''
+    for disk_path, action in changed.items():
+        if action != 'change' or disk_path not in events:
+            events[disk_path] = action
+
+
+def on_block_events(fd, condition):
+    changed = block_events.read()
+    if changed:
+        if not pending_events:
+            GLib.timeout_add(REFRESH_DELAY, refresh_partitions)
+        merge_events(pending_events, changed)
+    return True
+
+
+def refresh_partitions():
+    changed = dict(pending_events)
+    pending_events.clear()
+    # the other pages don't show partitions, they are read again when the page is
+    # shown; the installation itself formats and mounts, nothing is read then
+    if installer.builder.get_object("notebook1").get_current_page() != installer.PAGE_PARTITIONS:
+        merge_events(dirty_disks, changed)
+        return False
+    block_events.wait_for_udev()
+    installer.setup.partition_setup.refresh(changed)
+    return False
+
+
+def refresh_dirty_disks():
+    ''' Read the disks that changed while the partition page was not shown '''
+    if not dirty_disks:
+        return
+    changed = dict(dirty_disks)
+    dirty_disks.clear()
+    block_events.wait_for_udev()
+    installer.setup.partition_setup.refresh(changed)
 
 
 def update_html_preview(selection):
@@ -214,11 +230,14 @@ def manually_edit_partitions(widget):
         "treeview_disks").get_selection().get_selected()
     # prefer disk currently selected and show it first in gparted
     preferred = model[iter][-1] if iter else ''
-    disks = ' '.join(sorted((disk for disk, desc in model.disks),
-                            key=lambda disk: disk != preferred))
+    disks = sorted((disk for disk, desc in model.disks),
+                   key=lambda disk: disk != preferred)
     # umount disks (if possible) so gparted works out-of-the-box
-    os.system('umount ' + disks)
-    os.popen('gparted {} &'.format(disks))
+    commands.run(['umount'] + disks)
+    # only ext filesystems tell when they were written to, probe everything again
+    with probe_cache_lock:
+        probe_cache.clear()
+    commands.spawn(['gparted'] + disks)
 
 
 def build_grub_partitions():
@@ -239,6 +258,7 @@ def build_grub_partitions():
 
 
 class PartitionSetup(Gtk.TreeStore):
+    @tracing.traced('PartitionSetup')
     def __init__(self):
         super(PartitionSetup, self).__init__(str,  # path
                                              str,  # type (fs)
@@ -253,16 +273,21 @@ class PartitionSetup(Gtk.TreeStore):
         installer.setup.partition_setup = self
         self.html_chunks = {}, defaultdict(list)
 
-        os.popen('mkdir -p ' + TMP_MOUNTPOINT)
+        os.makedirs(TMP_MOUNTPOINT, exist_ok=True)
         installer.setup.gptonefi = is_efi_supported()
         self.disks = get_disks()
         print('Disks: ', self.disks)
+        # every disk there was, with or without a row
+        self.known = set(disk_path for disk_path, desc in self.disks)
         already_done_full_disk_format = False
+        # (path, description, partitions, mount points to assign) of every usable disk
+        found = []
         for disk_path, disk_description in self.disks:
             print("    Analyzing path='%s' description='%s'" %
                   (disk_path, disk_description))
             disk_device = parted.getDevice(disk_path)
             print("      - Found the device...")
+            assign_mount_format = None
             try:
                 disk = parted.Disk(disk_device)
                 print("      - Found the disk...")
@@ -278,7 +303,7 @@ class PartitionSetup(Gtk.TreeStore):
                     installer.window.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.WATCH))
                     print("Performing a full disk format")
                     if not already_done_full_disk_format:
-                        assign_mount_format = full_disk_format(disk_device)
+                        assign_mount_format = list(full_disk_format(disk_device))
                         already_done_full_disk_format = True
                     else:
                         # Format but don't assign mount points
@@ -287,161 +312,213 @@ class PartitionSetup(Gtk.TreeStore):
                     print("Done full disk format")
                     disk = parted.Disk(disk_device)
                     print("Got disk!")
-                except Exception as second_exception:
+                except Exception:
                     installer.window.get_window().set_cursor(None)
                     print(
                         "      - Found another issue while looking for the disk: %s" % detail)
                     continue  # Something is wrong with this disk, skip it
 
-            disk_iter = self.append(
-                None, (disk_description, '', '', '', '', '', '', None, disk_path))
-            print("      - Looking at partitions...")
-            free_space_partition = disk.getFreeSpacePartitions()
-            print("           -> %d free space partitions" %
-                  len(free_space_partition))
-            primary_partitions = disk.getPrimaryPartitions()
-            print("           -> %d primary partitions" %
-                  len(primary_partitions))
-            logical_partitions = disk.getLogicalPartitions()
-            print("           -> %d logical partitions" %
-                  len(logical_partitions))
-            raid_partitions = disk.getRaidPartitions()
-            print("           -> %d raid partitions" % len(raid_partitions))
-            lvm_partitions = disk.getLVMPartitions()
-            print("           -> %d LVM partitions" % len(lvm_partitions))
-
-            partition_set = tuple(free_space_partition + primary_partitions +
-                                  logical_partitions + raid_partitions + lvm_partitions)
-            print("           -> set of %d partitions" % len(partition_set))
-
-            partitions = []
-            for partition in partition_set:
-                part = Partition(partition)
-                print((partition.path, part.size, part.raw_size))
-                # skip ranges <5MB
-                if part.raw_size > 5242880:
-                    partitions.append(part)
-                else:
-                    print(("skipping ", partition.path, part.raw_size))
-            partitions = sorted(
-                partitions, key=lambda part: part.partition.geometry.start)
-
-            print("      - Found partitions...")
-            try:  # assign mount_as and format_as if disk was just auto-formatted
-                for partition, (mount_as, format_as) in zip(partitions, assign_mount_format):
-                    partition.mount_as = mount_as
-                    partition.format_as = format_as
-                del assign_mount_format
-            except NameError:
-                pass
-            print("      - Iterating partitions...")
-            # Needed to fix the 1% minimum Partition.size_percent
-            # .5 for good measure
-            sum_size_percent = sum(p.size_percent for p in partitions) + .5
+            found.append((disk_path, disk_description, self.read_partitions(disk),
+                          assign_mount_format))
+
+        # mounting and looking into the partitions is what takes time, all disks at once
+        probe_partitions([partition for found_disk in found for partition in found_disk[2]])
+        for disk_path, disk_description, partitions, assign_mount_format in found:
+            self.add_disk(disk_path, disk_description, partitions, assign_mount_format)
+
+    def read_partitions(self, disk):
+        ''' Partition objects of a parted disk, without the ranges too small to use '''
+        print("      - Looking at partitions...")
+        free_space_partition = disk.getFreeSpacePartitions()
+        print("           -> %d free space partitions" %
+              len(free_space_partition))
+        primary_partitions = disk.getPrimaryPartitions()
+        print("           -> %d primary partitions" %
+              len(primary_partitions))
+        logical_partitions = disk.getLogicalPartitions()
+        print("           -> %d logical partitions" %
+              len(logical_partitions))
+        raid_partitions = disk.getRaidPartitions()
+        print("           -> %d raid partitions" % len(raid_partitions))
+        lvm_partitions = disk.getLVMPartitions()
+        print("           -> %d LVM partitions" % len(lvm_partitions))
+
+        partition_set = tuple(free_space_partition + primary_partitions +
+                              logical_partitions + raid_partitions + lvm_partitions)
+        print("           -> set of %d partitions" % len(partition_set))
+
+        partitions = []
+        for partition in partition_set:
+            part = Partition(partition)
+            print((partition.path, part.size, part.raw_size))
+            # skip ranges <5MB
+            if part.raw_size > 5242880:
+                partitions.append(part)
+            else:
+                print(("skipping ", partition.path, part.raw_size))
+        return partitions
+
+    def add_disk(self, disk_path, disk_description, partitions, assign_mount_format=None,
+                 position=-1, index=None):
+        disk_iter = self.insert(
+            None, position, (disk_description, '', '', '', '', '', '', None, disk_path))
+        self.add_partitions(disk_iter, disk_path, partitions, assign_mount_format, index)
+
+    def add_partitions(self, disk_iter, disk_path, partitions, assign_mount_format=None,
+                       index=None):
+        ''' Add the partition rows of a disk, and the partitions to setup.partitions at index (the end if None) '''
+        partitions = sorted(
+            partitions, key=lambda part: part.partition.geometry.start)
+
+        print("      - Found partitions...")
+        if assign_mount_format is not None:
+            # assign mount_as and format_as, the disk was just auto-formatted
+            for partition, (mount_as, format_as) in zip(partitions, assign_mount_format):
+                partition.mount_as = mount_as
+                partition.format_as = format_as
+        print("      - Iterating partitions...")
+        # Needed to fix the 1% minimum Partition.size_percent
+        # .5 for good measure
+        sum_size_percent = sum(p.size_percent for p in partitions) + .5
+        if index is None:
+            index = len(installer.setup.partitions)
+        for number, partition in enumerate(partitions):
+            print("        . Appending partition %s..." % partition.name)
+            partition.size_percent = round(
+                partition.size_percent / sum_size_percent * 100, 1)
+            installer.setup.partitions.insert(index + number, partition)
+            self.append(disk_iter, (partition.name,
+                                    '<span foreground="{}">{}</span>'.format(
+                                        partition.color, partition.type),
+                                    partition.description,
+                                    partition.format_as,
+                                    partition.mount_as,
+                                    partition.size,
+                                    partition.free_space,
+                                    partition,
+                                    disk_path))
+
+    def find_disk(self, disk_path):
+        disk_iter = self.get_iter_first()
+        while disk_iter is not None and self[disk_iter][IDX_PART_DISK] != disk_path:
+            disk_iter = self.iter_next(disk_iter)
+        return disk_iter
+
+    def new_disk_position(self, disk_path, order):
+        ''' (row position, index in setup.partitions) of a new disk, so the disks stay in order '''
+        rank = dict((path, number) for number, path in enumerate(order))
+        position = 0
+        disk_iter = self.get_iter_first()
+        while disk_iter is not None and rank.get(self[disk_iter][IDX_PART_DISK], -1) < rank[disk_path]:
+            position += 1
+            disk_iter = self.iter_next(disk_iter)
+        if disk_iter is None:
+            return position, None
+        next_disk = self[disk_iter][IDX_PART_DISK]
+        for index, partition in enumerate(installer.setup.partitions):
+            if partition.partition.disk.device.path == next_disk:
+                return position, index
+        return position, None
+
+    @tracing.traced('PartitionSetup.refresh')
+    def refresh(self, changed):
+        ''' Read the disks of {disk path: action} again, a None path stands for all of them '''
+        # Only the rows of these disks are replaced; the mount points and
+        # formats chosen for partitions that are still there are kept. Disks
+        # that were skipped when the page was built stay skipped.
+        descriptions = dict(get_disks(refresh=True))
+        if None in changed:
+            changed = dict((disk_path, 'change') for disk_path, desc in self.disks)
+            changed.update((disk_path, 'add') for disk_path in descriptions
+                           if disk_path not in self.known)
+        self.known.update(descriptions)
+        treeview = installer.builder.get_object("treeview_disks")
+        model, row = treeview.get_selection().get_selected()
+        selected = (model[row][IDX_PART_DISK], model[row][IDX_PART_PATH]) if row else None
+
+        found = []
+        for disk_path, action in changed.items():
+            disk_iter = self.find_disk(disk_path)
+            if disk_iter is None and (action == 'change' or disk_path not in descriptions):
+                continue
+            print("    Refreshing path='%s' (%s)" % (disk_path, action))
+            old = [p for p in installer.setup.partitions
+                   if p.partition.disk.device.path == disk_path]
+            if disk_path not in descriptions:
+                # removed
+                installer.setup.partitions = [p for p in installer.setup.partitions
+                                              if p not in old]
+                self.remove(disk_iter)
+                continue
+            try:
+                disk = parted.Disk(parted.getDevice(disk_path))
+                partitions = self.read_partitions(disk)
+            except Exception as detail:
+                # no partition table (yet), the disk is shown without partitions
+                print("      - Could not read the disk: %s" % detail)
+                partitions = []
+            chosen = dict(((p.path, p.start, p.length), (p.mount_as, p.format_as)) for p in old)
             for partition in partitions:
-                print("        . Appending partition %s..." % partition.name)
-                partition.size_percent = round(
-                    partition.size_percent / sum_size_percent * 100, 1)
-                installer.setup.partitions.append(partition)
-                self.append(disk_iter, (partition.name,
-                                        '<span foreground="{}">{}</span>'.format(
-                                            partition.color, partition.type),
-                                        partition.description,
-                                        partition.format_as,
-                                        partition.mount_as,
-                                        partition.size,
-                                        partition.free_space,
-                                        partition,
-                                        disk_path))
+                if (partition.path, partition.start, partition.length) in chosen:
+                    partition.mount_as, partition.format_as = chosen[
+                        (partition.path, partition.start, partition.length)]
+            found.append((disk_path, disk_iter, partitions, old))
+
+        probe_partitions([partition for found_disk in found for partition in found_disk[2]])
+        for disk_path, disk_iter, partitions, old in found:
+            if disk_iter is None:
+                position, index = self.new_disk_position(disk_path, list(descriptions))
+                self.add_disk(disk_path, descriptions[disk_path], partitions,
+                              position=position, index=index)
+            else:
+                # where the partitions they replace were, setup.partitions stays in disk order
+                index = min((installer.setup.partitions.index(p) for p in old), default=None)
+                installer.setup.partitions = [p for p in installer.setup.partitions
+                                              if p not in old]
+                while self.iter_has_child(disk_iter):
+                    self.remove(self.iter_children(disk_iter))
+                self.add_partitions(disk_iter, disk_path, partitions, index=index)
+        self.disks = [(disk_path, desc) for disk_path, desc in descriptions.items()
+                      if self.find_disk(disk_path) is not None]
+
+        treeview.expand_all()
+        if selected is not None:
+            for disk_row in self:
+                for row in [disk_row] + list(disk_row.iterchildren()):
+                    if (row[IDX_PART_DISK], row[IDX_PART_PATH]) == selected:
+                        treeview.get_selection().select_iter(row.iter)
 
     def get_html(self, disk):
         return ""
 
 
+def probe_partitions(partitions):
+    print("      - Probing %d partitions..." % len(partitions))
+    with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as pool:
+        list(pool.map(Partition.probe, partitions))
+
+
 @idle
 def show_error(message):
     from frontend.gtk_interface import ErrorDialog
     ErrorDialog(("Installer"), message)
 
 
-def full_disk_format(device, create_boot=False, create_swap=True):
-    # Create a default partition set up
-    disk_label = ('gpt' if device.getLength('B') > 2**32*.9 * device.sectorSize  # size of disk > ~2TB
-                  or installer.setup.gptonefi
-                  else 'msdos')
-    return_code = os.system("parted -s %s mklabel %s" %
-                            (device.path, disk_label))
-    if return_code != 0:
-        show_error(
-            ("The partition table couldn't be written for %s. Restart the computer and try again.") % device.path)
+def full_disk_format(device, create_boot=False, create_swap=True, format_root=True):
+    try:
+        return devices.full_disk_format(device, create_boot, create_swap, format_root,
+                                        gptonefi=installer.setup.gptonefi)
+    except Exception as detail:
+        show_error(str(detail))
         Gtk.main_quit()
         sys.exit(1)
 
-    mkpart = (
-        # (condition, mount_as, format_as, mkfs command, size_mb)
-        # EFI
-        (installer.setup.gptonefi, EFI_MOUNT_POINT,
-         'vfat', 'mkfs.vfat {} -F 32 ', 300),
-        # boot
-        (create_boot, '/boot', 'ext4', 'mkfs.ext4 -F {}', 1024),
-        # swap - equal to RAM for hibernate to work well (but capped at ~8GB)
-        (create_swap, SWAP_MOUNT_POINT, 'swap', 'mkswap {}', min(8800, int(round(
-            1.1/1024 * int(getoutput("awk '/^MemTotal/{ print $2 }' /proc/meminfo")), -2)))),
-        # root
-        (True, '/', 'ext4', 'mkfs.ext4 -F {}', 0),
-    )
-    def run_parted(cmd): return os.system(
-        'parted --script --align optimal {} {} ; sync'.format(device.path, cmd))
-    start_mb = 2
-    partition_number = 0
-    partition_prefix = ""
-    if device.path.startswith("/dev/nvme"):
-        partition_prefix = "p"
-    for partition in mkpart:
-        if partition[0]:
-            partition_number = partition_number + 1
-            mkfs = partition[3]
-            size_mb = partition[4]
-            end = '{}MB'.format(start_mb + size_mb) if size_mb else '100%'
-            mkpart_cmd = 'mkpart primary {}MB {}'.format(start_mb, end)
-            print(mkpart_cmd)
-            run_parted(mkpart_cmd)
-            partition_path = "%s%s%d" % (
-                device.path, partition_prefix, partition_number)
-            num_tries = 0
-            while True:
-                if os.path.exists(partition_path):
-                    break
-                if num_tries < 5:
-                    num_tries += 1
-                    print(("Could not find %s, waiting 1s..." % partition_path))
-                    os.system("sync")
-                    time.sleep(1)
-                else:
-                    show_error(
-                        ("The partition %s could not be created. The installation will stop. Restart the computer and try again.") % partition_path)
-                    Gtk.main_quit()
-                    sys.exit(1)
-            mkfs = mkfs.format(partition_path)
-            print(mkfs)
-            os.system(mkfs)
-            start_mb += size_mb + 1
-    if installer.setup.gptonefi:
-        run_parted('set 1 boot on')
-    return ((i[1], i[2]) for i in mkpart if i[0])
-
-
-def to_human_readable(size):
-    for unit in [' ', ('kB'), ('MB'), ('GB'), ('TB'), 'PB', 'EB', 'ZB', 'YB']:
-        if size < 1000:
-            return "{:.1f} {}".format(size, unit)
-        size /= 1000
-
 
 class Partition(object):
     format_as = ''
     mount_as = ''
 
+    @tracing.traced('Partition', 'init')
     def __init__(self, partition):
         assert partition.type not in (
             parted.PARTITION_METADATA, parted.PARTITION_EXTENDED)
@@ -450,6 +527,7 @@ class Partition(object):
         print("              -> Building partition object for %s" % self.path)
 
         self.partition = partition
+        self.start = partition.geometry.start
         self.length = partition.getLength()
         print("                  . length %d" % self.length)
 
@@ -496,88 +574,15 @@ class Partition(object):
         if "swap" in self.type:
             self.mount_as = SWAP_MOUNT_POINT
 
-        # identify partition's description and used space
+        # parted is only used from the main thread, probe() runs in a worker
+        self.flags = []
         try:
-            print("                  . About to mount it...")
-            os.system('mount --read-only {} {}'.format(self.path, TMP_MOUNTPOINT))
-            size, free, self.used_percent, mount_point = str(getoutput(
-                "df {0} | grep '^{0}' | awk '{{print $2,$4,$5,$6}}' | tail -1".format(self.path)).split(None, 3))
-            self.raw_size = int(size)*1024
-            print("                  . size %s, free %s, self.used_percent %s, mount_point %s" % (
-                size, free, self.used_percent, mount_point))
-        except ValueError:
-            print("                  . value error!")
-            if "swap" in self.type:
-                self.os_fs_info, self.description, self.free_space, self.used_percent = ': ' + \
-                    self.type, 'swap', '', 0
-            else:
-                print('WARNING: Partition {} or type {} failed to mount!'.format(
-                    self.path, partition.type))
-                self.os_fs_info, self.description, self.free_space, self.used_percent = ': ' + \
-                    self.type, '', '', 0
-            print("                  . self.os_fs_info %s, self.description %s, self.free_space %s, self.used_percent %s" % (
-                self.os_fs_info, self.description, self.free_space, self.used_percent))
-        else:
-            print("                  . About to find more about it...")
-            # for mountable partitions, more accurate than the getLength size above
-            self.size = to_human_readable(int(size)*1024)
-            # df returns values in 1024B-blocks by default
-            self.free_space = to_human_readable(int(free)*1024)
-            self.used_percent = self.used_percent.strip(b'%') or 0
-            description = ''
-            if path_exists(str(mount_point), str('Windows/servicing/Version')):
-                description = 'Windows ' + {
-                    '6.4': '10',
-                    '6.3': '8.1',
-                    '6.2': '8',
-                    '6.1': '7',
-                    '6.0': 'Vista',
-                    '5.2': 'XP Pro x64',
-                    '5.1': 'XP',
-                    '5.0': '2000',
-                    '4.9': 'ME',
-                    '4.1': '98',
-                    '4.0': '95',
-                }.get(getoutput('ls {}/Windows/servicing/Version'.format(mount_point))[:3], '')
-            elif path_exists(mount_point, 'Boot/BCD'):
-                description = 'Windows bootloader/recovery'
-            elif path_exists(mount_point, 'Windows/System32'):
-                description = 'Windows'
-            elif path_exists(mount_point, 'System/Library/CoreServices/SystemVersion.plist'):
-                description = 'Mac OS X'
-            elif path_exists(mount_point, 'etc/'):
-                description = getoutput("su -c '{{ . {0}/etc/lsb-release && echo $DISTRIB_DESCRIPTION; }} || \
-                                                {{ . {0}/etc/os-release && echo $PRETTY_NAME; }}' mint".format(mount_point)) or 'Unix'
-            else:
-                try:
-                    if partition.active:
-                        for flag in partition.getFlagsAsString().split(", "):
-                            if flag in ["boot", "esp"]:
-                                description = 'EFI System Partition'
-                                self.mount_as = EFI_MOUNT_POINT
-                                break
-                except Exception as detail:
-                    # best effort
-                    print("Could not read partition flags for %s: %s" %
-                          (self.path, detail))
-            self.description = description
-            self.os_fs_info = ': {0.description} ({0.type}; {0.size}; {0.free_space})'.format(
-                self) if description else ': ' + self.type
-            print("                  . self.description %s self.os_fs_info %s" % (
-                self.description, self.os_fs_info))
-        finally:
-            print("                  . umounting it")
-            os.system('umount ' + TMP_MOUNTPOINT + ' 2>/dev/null')
-            print("                  . done")
-
-        self.html_name = self.name.split('/')[-1]
-        self.html_description = self.description
-        if (self.size_percent < 10 and len(self.description) > 5):
-            self.html_description = "%s..." % self.description[0:5]
-        if (self.size_percent < 5):
-            # Not enough space, don't write the name
-            self.html_name = ""
-            self.html_description = ""
+            if partition.active:
+                self.flags = partition.getFlagsAsString().split(", ")
+        except Exception as detail:
+            # best effort
+            print("Could not read partition flags for %s: %s" %
+                  (self.path, detail))
 
         self.color = {
             # colors approximately from gparted (find matching set in usr/share/disk-partitions.html)
@@ -599,6 +604,127 @@ class Partition(object):
             parted.PARTITION_EXTENDED: '#a9a9a9',
         }.get(self.type, '#a9a9a9')
 
+    @tracing.traced('Partition.probe', 'probe')
+    def probe(self):
+        ''' Find the OS and used space of the partition, from its superblock where possible '''
+        # Only filesystems whose superblock does not tell the free space, or
+        # whose files debugfs can't read, are mounted: read-only, without
+        # replaying their journal, on a scratch directory of their own.
+        self.description, self.free_space, self.used_percent = '', '', 0
+        superblock = None
+        if self.partition.number != -1:
+            superblock = devices.read_superblock(self.path)
+        if superblock is None or superblock.usage != 'filesystem':
+            # swap, LUKS, RAID and LVM members can't be looked into
+            if "swap" in self.type or (superblock is not None and superblock.type == 'swap'):
+                self.description = 'swap'
+            elif superblock is None and self.partition.number != -1:
+                print('WARNING: No filesystem found on partition {} (type {})'.format(
+                    self.path, self.type))
+            self.os_fs_info = ': ' + self.type
+            print("                  . self.os_fs_info %s, self.description %s" % (
+                self.os_fs_info, self.description))
+        else:
+            print("                  . %s filesystem, label '%s'" % (superblock.type, superblock.label))
+            key = (self.path, self.start, self.length, superblock.type, superblock.uuid,
+                   superblock.label, superblock.generation)
+            with probe_cache_lock:
+                cached = probe_cache.get(key)
+            if cached is not None:
+                print("                  . unchanged since it was last probed")
+                size, free, description = cached
+            else:
+                size, free = superblock.size, superblock.free
+                description = None
+                if superblock.type in ('ext2', 'ext3', 'ext4'):
+                    description = devices.ext_os_description(self.path)
+                if size is None or description is None:
+                    size, free, description = self.probe_mounted(superblock.type, size, free, description)
+                if description is not None:
+                    # a mount that failed is tried again next time
+                    with probe_cache_lock:
+                        probe_cache[key] = (size, free, description)
+            if size:
+                # more accurate than the partition size for filesystems that don't fill it
+                self.raw_size = size
+                self.size = to_human_readable(size)
+                self.free_space = to_human_readable(free)
+                self.used_percent = round(100 * (size - free) / size)
+            if not description and ("boot" in self.flags or "esp" in self.flags):
+                description = 'EFI System Partition'
+                self.mount_as = EFI_MOUNT_POINT
+            self.description = description or ''
+            self.os_fs_info = ': {0.description} ({0.type}; {0.size}; {0.free_space})'.format(
+                self) if self.description else ': ' + self.type
+            print("                  . self.description %s self.os_fs_info %s" % (
+                self.description, self.os_fs_info))
+
+        self.html_name = self.name.split('/')[-1]
+        self.html_description = self.description
+        if (self.size_percent < 10 and len(self.description) > 5):
+            self.html_description = "%s..." % self.description[0:5]
+        if (self.size_percent < 5):
+            # Not enough space, don't write the name
+            self.html_name = ""
+            self.html_description = ""
+
+    def probe_mounted(self, fstype, size, free, description):
+        ''' Fill in what the superblock did not tell by mounting the partition, returns (size, free, description) '''
+        mountpoint = tempfile.mkdtemp(dir=TMP_MOUNTPOINT)
+        try:
+            print("                  . About to mount it...")
+            # mount_device() goes through mount(8) for the drivers the kernel lacks
+            for driver in [fstype] + devices.OTHER_DRIVERS.get(fstype, []):
+                try:
+                    mounts.mount_device(self.path, mountpoint, driver,
+                                        devices.read_only_options(driver))
+                    break
+                except OSError as detail:
+                    print('WARNING: Partition {} or type {} failed to mount: {}'.format(
+                        self.path, driver, detail))
+            else:
+                return size, free, description
+            try:
+                if size is None:
+                    size, free = devices.usage(mountpoint)
+                if description is None:
+                    description = self.find_os(mountpoint)
+            finally:
+                print("                  . umounting it")
+                try:
+                    mounts.umount(mountpoint)
+                except OSError as detail:
+                    print(detail)
+        finally:
+            try:
+                os.rmdir(mountpoint)
+            except OSError as detail:
+                print("Could not remove %s: %s" % (mountpoint, detail))
+        return size, free, description
+
+    def find_os(self, mount_point):
+        if path_exists(mount_point, 'Windows/servicing/Version'):
+            return 'Windows ' + {
+                '6.4': '10',
+                '6.3': '8.1',
+                '6.2': '8',
+                '6.1': '7',
+                '6.0': 'Vista',
+                '5.2': 'XP Pro x64',
+                '5.1': 'XP',
+                '5.0': '2000',
+                '4.9': 'ME',
+                '4.1': '98',
+                '4.0': '95',
+            }.get(''.join(sorted(os.listdir(os.path.join(mount_point, 'Windows/servicing/Version'))))[:3], '')
+        elif path_exists(mount_point, 'Boot/BCD'):
+            return 'Windows bootloader/recovery'
+        elif path_exists(mount_point, 'Windows/System32'):
+            return 'Windows'
+        elif path_exists(mount_point, 'System/Library/CoreServices/SystemVersion.plist'):
+            return 'Mac OS X'
+        return devices.os_description(mount_point) or ''
+
     def print_partition(self):
         print("Device: %s, format as: %s, mount as: %s" %
               (self.path, self.format_as, self.mount_as))
@@ -622,8 +748,8 @@ class PartitionDialog(object):
         # Build supported filesystems list
         filesystems = ['', 'swap']
         for path in ["/bin", "/sbin", "/usr/bin", "/usr/sbin"]:
-            for fs in getoutput('echo %s/mkfs.*' % path).split():
-                filesystems.append(str(fs).split("mkfs.")[1].replace("'", ""))
+            for fs in glob.glob('%s/mkfs.*' % path):
+                filesystems.append(fs.split("mkfs.")[1])
         filesystems = sorted(filesystems)
         filesystems = sorted(filesystems, key=lambda x: 0 if x in (
             '', 'ext4') else 1 if x == 'swap' else 2)
@@ -0,0 +1,104 @@
+import time
+
+import tracing
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Task(object):
+    ''' A named installation step and the steps it has to wait for '''
+
+    def __init__(self, name, func, requires=(), message=None):
+        self.name = name
+        self.func = func
+        self.requires = list(requires)
+        self.message = message or name
+
+
+class TaskGraph(object):
+    ''' Runs tasks as soon as the tasks they require have finished '''
+
+    def __init__(self, workers=4, progresshook=None):
+        self.workers = workers
+        # called with (finished tasks, total tasks, message)
+        self.progresshook = progresshook
+        self.tasks = {}
+        # name -> seconds it took
+        self.timings = {}
+
+    def add(self, name, func, requires=(), message=None):
+        if name in self.tasks:
+            raise Exception("Task %s added twice" % name)
+        self.tasks[name] = Task(name, func, requires, message)
+        return name
+
+    def check(self):
+        ''' Make sure every requirement exists and there are no cycles '''
+        for task in self.tasks.values():
+            for name in task.requires:
+                if name not in self.tasks:
+                    raise Exception("Task %s requires unknown task %s" %
+                                    (task.name, name))
+        state = {}
+
+        def visit(task):
+            if state.get(task.name) == 'done':
+                return
+            if state.get(task.name) == 'visiting':
+                raise Exception("Task %s depends on itself" % task.name)
+            state[task.name] = 'visiting'
+            for name in task.requires:
+                visit(self.tasks[name])
+            state[task.name] = 'done'
+        for task in self.tasks.values():
+            visit(task)
+
+    def run(self):
+        ''' Run every task, raises an exception naming the tasks that failed or could not run '''
+        self.check()
+        total = len(self.tasks)
+        finished, failed, skipped = set(), {}, set()
+        pending = dict(self.tasks)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                for task in list(pending.values()):
+                    if any(name in failed or name in skipped for name in task.requires):
+                        skipped.add(task.name)
+                        del pending[task.name]
+                    elif all(name in finished for name in task.requires):
+                        del pending[task.name]
+                        self.report(len(finished), total, task.message)
+                        running[pool.submit(self.run_task, task)] = task
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as detail:
+                        print("Task %s failed: %s" % (task.name, detail))
+                        failed[task.name] = detail
+                    else:
+                        finished.add(task.name)
+                    self.report(len(finished), total, task.message)
+        # whatever is left waits on a task that did not run
+        skipped.update(pending)
+        print("Step timings: %s" % ', '.join("%s %.1fs" % (name, seconds)
+                                            for name, seconds in self.timings.items()))
+        if failed or skipped:
+            raise Exception("Failed: %s" % '; '.join(
+                ["%s (%s)" % (name, detail) for name, detail in failed.items()] +
+                ["%s (not run)" % name for name in sorted(skipped)]))
+
+    def run_task(self, task):
+        start = time.monotonic()
+        try:
+            with tracing.span(task.name, 'task', requires=task.requires):
+                task.func()
+        finally:
+            self.timings[task.name] = time.monotonic() - start
+
+    def report(self, current, total, message):
+        if self.progresshook is not None:
+            self.progresshook(current, total, message)
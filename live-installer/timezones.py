@@ -4,7 +4,8 @@
 import math
 import re
 from gi.repository import Gtk, Gdk, GObject, GdkPixbuf
-from subprocess import getoutput
+import commands
+import tracing
 from collections import defaultdict, namedtuple
 from datetime import datetime, timedelta
 from PIL import Image, ImageEnhance, ImageChops, ImageOps
@@ -76,6 +77,7 @@ Timezone = namedtuple('Timezone', 'name ccode x y'.split())
 
 
 @debug
+@tracing.traced(category='gui')
 def build_timezones(_installer):
     global installer, time_label, time_label_box, timezone
     installer = _installer
@@ -96,8 +98,12 @@ def build_timezones(_installer):
         return defaultdict(autovivified)
     hierarchy = autovivified()
 
-    for line in getoutput("awk '/^[^#]/{ print $1,$2,$3 }' /usr/share/zoneinfo/zone.tab | sort -k3").split('\n'):
-        ccode, coords, name = line.split()
+    zones = []
+    with open('/usr/share/zoneinfo/zone.tab') as zone_tab:
+        for line in zone_tab:
+            if line.strip() and not line.startswith('#'):
+                zones.append(line.split()[:3])
+    for ccode, coords, name in sorted(zones, key=lambda zone: zone[2]):
         lat, lon = TZ_SPLIT_COORDS.search(coords).groups()
         x, y = pixel_position(to_float(lat, 2), to_float(lon, 3))
         if x < 0:
@@ -242,7 +248,7 @@ IS_WINTER = datetime.now().timetuple().tm_yday not in list(
 
 def select_timezone(tz):
     # Adjust time preview to current timezone (using `date` removes need for pytz package)
-    offset = getoutput('TZ={} date +%z'.format(tz.name))
+    offset = commands.output(['date', '+%z'], env={'TZ': tz.name})
     tzadj = ADJUST_HOURS_MINUTES.search(offset).groups()
     global adjust_time
     adjust_time = timedelta(hours=int(tzadj[0] + tzadj[1]),
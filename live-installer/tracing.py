@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+# Timeline of what the installer did, in the Chrome trace event format.
+#
+# Steps, commands and GUI build phases record spans with span() or @traced;
+# save() writes them to TRACE_FILE, which loads in chrome://tracing or
+# https://ui.perfetto.dev. Run this file on a trace for a per-span summary:
+#
+#     python3 tracing.py /var/log/live-installer-trace.json
+
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+TRACE_FILE = '/var/log/live-installer-trace.json'
+
+events = []
+lock = threading.Lock()
+threads = {}
+
+
+def now():
+    ''' Microseconds, the unit of trace timestamps '''
+    return time.perf_counter() * 1000000
+
+
+class span(object):
+    ''' Records the time spent in a with block as a span; args end up in the trace viewer '''
+
+    def __init__(self, name, category='step', **args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = now()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args['error'] = str(exc_value)
+        record(self.name, self.category, self.start, now() - self.start, self.args)
+        return False
+
+
+def traced(name=None, category='step'):
+    ''' Decorator recording every call of a function as a span '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name or func.__name__, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record(name, category, start, duration, args=None):
+    thread = threading.current_thread()
+    event = {'name': name, 'cat': category, 'ph': 'X',
+             'ts': round(start, 1), 'dur': round(duration, 1),
+             'pid': os.getpid(), 'tid': thread.ident}
+    if args:
+        event['args'] = args
+    with lock:
+        threads[thread.ident] = thread.name
+        events.append(event)
+
+
+def save(path=TRACE_FILE):
+    ''' Write the spans recorded so far '''
+    with lock:
+        trace = list(events)
+        trace += [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                   'args': {'name': name}} for tid, name in threads.items()]
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+        os.replace(tmp, path)
+        print("Trace written to %s (%d events)" % (path, len(trace)))
+    except OSError as detail:
+        print("Could not write the trace to %s: %s" % (path, detail))
+
+
+def summary(trace):
+    ''' (name, calls, total seconds) of every span name, slowest first '''
+    totals = {}
+    for event in trace.get('traceEvents', []):
+        if event.get('ph') == 'X':
+            calls, seconds = totals.get(event['name'], (0, 0.0))
+            totals[event['name']] = (calls + 1, seconds + event['dur'] / 1000000)
+    return sorted(((name, calls, seconds) for name, (calls, seconds) in totals.items()),
+                  key=lambda item: item[2], reverse=True)
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1] if len(sys.argv) > 1 else TRACE_FILE) as f:
+        for name, calls, seconds in summary(json.load(f))[:40]:
+            print("%9.2fs %5d  %s" % (seconds, calls, name))